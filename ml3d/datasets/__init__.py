@@ -9,7 +9,8 @@ from .toronto3d import Toronto3D
 from .customdataset import Custom3D
 from .semantic3d import Semantic3D
 from .inference_dummy import InferenceDummySplit
-from .samplers import SemSegRandomSampler, SemSegSpatiallyRegularSampler
+from .samplers import (SemSegRandomSampler, SemSegSpatiallyRegularSampler,
+                       SemSegClassBalancedSampler)
 from . import utils
 
 from .kitti import KITTI
@@ -23,5 +24,5 @@ __all__ = [
     'SemanticKITTI', 'S3DIS', 'Toronto3D', 'ParisLille3D', 'Semantic3D',
     'Custom3D', 'utils', 'KITTI', 'Waymo', 'NuScenes', 'Lyft', 'ShapeNet',
     'SemSegRandomSampler', 'InferenceDummySplit',
-    'SemSegSpatiallyRegularSampler', 'Argoverse',
+    'SemSegSpatiallyRegularSampler', 'SemSegClassBalancedSampler', 'Argoverse',
 ]
@@ -19,7 +19,21 @@ class BaseDataset(ABC):
     compatible with pipelines.
 
     Args:
-        **kwargs: The configuration of the model as keyword arguments.
+        **kwargs: The configuration of the model as keyword arguments. With
+            use_cache, the preprocessed samples are cached in cache_dir,
+            further configured by:
+
+            cache_mem_size: Size in bytes of a RAM tier in front of the cache
+                on disk, 0 (default) disables it.
+            cache_shm_dir: Directory on a shared memory filesystem (e.g.
+                /dev/shm) holding the RAM tier, shared by the dataloader
+                workers. None (default) keeps it in the process heap.
+            preprocess_workers: Number of processes preprocessing the
+                uncached samples up front, 0 (default) preprocesses them in
+                the calling process.
+            cache_check_stale: Preprocess again the cached samples whose
+                source file changed, which stats every source file. False
+                (default) only preprocesses the uncached samples.
 
     Attributes:
         cfg: The configuration file as Config object that stores the keyword
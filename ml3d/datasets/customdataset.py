@@ -66,7 +66,12 @@ class Custom3DSplit():
         pc_path = Path(self.path_list[idx])
         name = pc_path.name.replace('.npy', '')
 
-        attr = {'name': name, 'path': str(pc_path), 'split': self.split}
+        attr = {
+            'idx': idx,
+            'name': name,
+            'path': str(pc_path),
+            'split': self.split
+        }
 
         return attr
 
@@ -11,7 +11,7 @@ import logging
 
 from .utils import DataProcessing
 from .base_dataset import BaseDataset, BaseDatasetSplit
-from ..utils import make_dir, DATASET
+from ..utils import make_dir, load_kdtree, DATASET
 
 logging.basicConfig(
     level=logging.INFO,
@@ -166,8 +166,12 @@ class S3DIS(BaseDataset):
         ).parent.parent / 'cache' / 'KDTree' / file_path.name.replace(
             ".ply", ".pkl")
 
-        with open(kdtree_path, 'rb') as f:
-            search_tree = pickle.load(f)
+        if kdtree_path.with_suffix('').is_dir():
+            # Tree saved with save_kdtree, memory-mapped without unpickling.
+            search_tree = load_kdtree(str(kdtree_path.with_suffix('')))
+        else:
+            with open(kdtree_path, 'rb') as f:
+                search_tree = pickle.load(f)
         points = np.array(search_tree.data, copy=False)
 
         pc_feat_labels_path = kdtree_path.parent.parent / 'sub' / file_path.name.replace(
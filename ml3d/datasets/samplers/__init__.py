@@ -1,4 +1,8 @@
 from .semseg_random import SemSegRandomSampler
 from .semseg_spatially_regular import SemSegSpatiallyRegularSampler
+from .semseg_class_balanced import SemSegClassBalancedSampler
 
-__all__ = ['SemSegRandomSampler', 'SemSegSpatiallyRegularSampler']
+__all__ = [
+    'SemSegRandomSampler', 'SemSegSpatiallyRegularSampler',
+    'SemSegClassBalancedSampler'
+]
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class BaseSampler(object):
+    """Base class of the samplers, which owns their random generator.
+
+    The generator is seeded with 'seed' from the sampler config of the dataset,
+    or with fresh entropy if it is not given. The workers of a dataloader
+    reseed their copy of the sampler with set_seed(), and the state of the
+    sampler can be saved and restored with state_dict() and load_state_dict()
+    to resume a training.
+
+    For distributed training the sampler is sharded with shard(). All ranks
+    then draw the same samples from the same seed and each keeps its part.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.length = len(dataset) if dataset is not None else 0
+        self.split = getattr(dataset, 'split', None)
+
+        cfg = getattr(dataset, 'cfg', {})
+        self.seed = cfg.get('sampler', {}).get('seed', None)
+        self.rng = np.random.default_rng(self.seed)
+
+        self.rank = 0
+        self.world_size = 1
+
+    def __len__(self):
+        # Number of samples of this rank, each rank gets as many.
+        return -(-self.length // self.world_size)
+
+    def get_num_clouds(self):
+        """Number of clouds to draw from, which may differ from the length."""
+        return len(self.dataset) if self.dataset is not None else self.length
+
+    def set_seed(self, seed):
+        """Reseed the generator, e.g. in a dataloader worker."""
+        self.rng = np.random.default_rng(seed)
+
+    def shard(self, rank, world_size):
+        """Sample only the part of rank out of world_size ranks."""
+        self.rank = rank
+        self.world_size = world_size
+
+    def get_shard(self, ids):
+        """Get the part of this rank of the ids drawn by all ranks.
+
+        The ids are repeated to give each rank the same number of samples.
+        """
+        ids = np.resize(ids, len(self) * self.world_size)
+        return ids[self.rank::self.world_size]
+
+    def state_dict(self):
+        """Returns the state of the sampler as a dict."""
+        return {'rng': self.rng.bit_generator.state}
+
+    def load_state_dict(self, state_dict):
+        """Restores the state of the sampler from state_dict()."""
+        self.rng.bit_generator.state = state_dict['rng']
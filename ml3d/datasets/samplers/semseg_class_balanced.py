@@ -0,0 +1,157 @@
+import numpy as np
+
+from .base_sampler import BaseSampler
+from ...utils import SAMPLER
+
+
+class SemSegClassBalancedSampler(BaseSampler):
+    """Class balanced sampler for semantic segmentation datasets.
+
+    Crop centers are drawn such that each class is picked with a probability
+    proportional to its weight, however few points it has. The weights are
+    given by 'class_weights' in the sampler config (all classes weigh the
+    same by default), the classes in 'ignored_label_inds' are never picked.
+
+    The class histograms of the clouds are read from the cache index. Clouds
+    are then drawn with the weighted share of the classes they hold. Without
+    the histograms the clouds are drawn uniformly and the classes are only
+    balanced within each cloud.
+    """
+
+    def __init__(self, dataset):
+        super().__init__(dataset)
+
+        sampler_cfg = dataset.cfg.get('sampler', {})
+        self.class_weights = sampler_cfg.get('class_weights', None)
+        self.ignored_label_inds = dataset.cfg.get('ignored_label_inds', [])
+
+        self.class_counts = None
+        self.cloud_probs = None
+
+    def initialize_with_dataloader(self, dataloader):
+        self.length = len(dataloader)
+
+        cache_convert = getattr(dataloader, 'cache_convert', None)
+        if cache_convert is None:
+            return
+
+        dataset = dataloader.dataset
+        counts = [
+            cache_convert.class_counts(dataset.get_attr(i)['name'])
+            for i in range(len(dataset))
+        ]
+        if any(c is None for c in counts):
+            return
+
+        num_classes = max(len(c) for c in counts)
+        self.class_counts = np.zeros((len(counts), num_classes), np.int64)
+        for i, c in enumerate(counts):
+            self.class_counts[i, :len(c)] = c
+
+        # Each class spreads its weight over the clouds by their share of its
+        # points.
+        totals = np.maximum(self.class_counts.sum(axis=0), 1)
+        cloud_mass = self.class_counts / totals * self.get_weights(num_classes)
+        cloud_mass = cloud_mass.sum(axis=1)
+        if cloud_mass.sum() > 0:
+            self.cloud_probs = cloud_mass / cloud_mass.sum()
+
+    def get_weights(self, num_classes):
+        """Weight of each label up to num_classes."""
+        weights = np.ones(num_classes)
+        if self.class_weights is not None:
+            class_weights = np.asarray(self.class_weights, dtype=np.float64)
+            n = min(num_classes, len(class_weights))
+            weights[:n] = class_weights[:n]
+            weights[n:] = 0
+        for ign in self.ignored_label_inds:
+            if 0 <= ign < num_classes:
+                weights[ign] = 0
+        return weights
+
+    def get_cloud_sampler(self):
+
+        def gen():
+            rng = self.rng
+            if self.cloud_probs is None:
+                ids = rng.permutation(self.get_num_clouds())
+            else:
+                ids = rng.choice(len(self.cloud_probs),
+                                 size=self.length,
+                                 p=self.cloud_probs)
+            for i in self.get_shard(ids):
+                yield i
+
+        return gen()
+
+    def get_centers(self, num_points, label, num_centers):
+        """Draw the indices of crop centers from a cloud by class."""
+        rng = self.rng
+        if label is None:
+            return rng.integers(num_points, size=num_centers)
+
+        label = np.asarray(label).reshape(-1)
+        counts = np.bincount(label, minlength=1)
+        class_mass = self.get_weights(len(counts)) * (counts > 0)
+        if self.class_counts is not None:
+            # Weigh the classes of the cloud by their share of the split.
+            totals = np.maximum(self.class_counts.sum(axis=0), 1)
+            num_classes = min(len(counts), len(totals))
+            class_mass[:num_classes] *= (counts[:num_classes] /
+                                         totals[:num_classes])
+        if class_mass.sum() == 0:
+            return rng.integers(num_points, size=num_centers)
+
+        classes = rng.choice(len(counts),
+                             size=num_centers,
+                             p=class_mass / class_mass.sum())
+        centers = np.empty(num_centers, dtype=np.int64)
+        for c in np.unique(classes):
+            mask = classes == c
+            inds = np.flatnonzero(label == c)
+            centers[mask] = inds[rng.integers(len(inds), size=mask.sum())]
+        return centers
+
+    def get_point_sampler(self):
+
+        def _class_centered_gen(**kwargs):
+            pc = kwargs.get('pc', None)
+            num_points = kwargs.get('num_points', None)
+            radius = kwargs.get('radius', None)
+            search_tree = kwargs.get('search_tree', None)
+            if pc is None or num_points is None or search_tree is None:
+                raise KeyError("Please provide pc, num_points, and search_tree \
+                    for point_sampler in SemSegClassBalancedSampler")
+
+            num_crops = kwargs.get('num_crops', None)
+            rng = self.rng
+
+            center_idx = self.get_centers(len(pc), kwargs.get('label', None),
+                                          1 if num_crops is None else num_crops)
+            center_point = pc[center_idx, :]
+
+            if radius is not None:
+                idxs = search_tree.query_radius(center_point, r=radius)
+                idxs = [rng.permutation(i) for i in idxs]
+                pc = [pc[i] for i in idxs]
+            else:
+                if (pc.shape[0] < num_points):
+                    diff = num_points - pc.shape[0]
+                    idxs = np.arange(pc.shape[0])
+                    idxs = np.broadcast_to(idxs, (len(center_idx), len(idxs)))
+                    extra = rng.integers(pc.shape[0],
+                                         size=(len(center_idx), diff))
+                    idxs = np.concatenate([idxs, extra], axis=1)
+                else:
+                    idxs = search_tree.query(center_point, k=num_points)[1]
+                idxs = rng.permuted(idxs, axis=1)
+                pc = pc[idxs]
+
+            if num_crops is None:
+                return pc[0], idxs[0], center_point
+            return pc, idxs, center_point
+
+        return _class_centered_gen
+
+
+SAMPLER._register_module(SemSegClassBalancedSampler)
@@ -1,19 +1,14 @@
 import numpy as np
-import random
 
+from .base_sampler import BaseSampler
 from ...utils import SAMPLER
 
 
-class SemSegRandomSampler(object):
+class SemSegRandomSampler(BaseSampler):
     """Random sampler for semantic segmentation datsets"""
 
-    def __init__(self, dataset):
-        self.dataset = dataset
-        self.length = len(dataset)
-        self.split = self.dataset.split
-
-    def __len__(self):
-        return self.length
+    def __init__(self, dataset=None):
+        super().__init__(dataset)
 
     def initialize_with_dataloader(self, dataloader):
         self.length = len(dataloader)
@@ -21,14 +16,13 @@ class SemSegRandomSampler(object):
     def get_cloud_sampler(self):
 
         def gen():
-            ids = np.random.permutation(self.length)
+            ids = self.get_shard(self.rng.permutation(self.get_num_clouds()))
             for i in ids:
                 yield i
 
         return gen()
 
-    @staticmethod
-    def get_point_sampler():
+    def get_point_sampler(self):
 
         def _random_centered_gen(**kwargs):
             pc = kwargs.get('pc', None)
@@ -38,17 +32,28 @@ class SemSegRandomSampler(object):
                 raise KeyError("Please provide pc, num_points, and search_tree \
                     for point_sampler in SemSegRandomSampler")
 
-            center_idx = np.random.choice(len(pc), 1)
-            center_point = pc[center_idx, :].reshape(1, -1)
+            # With num_crops, num_crops centers are drawn and all crops are
+            # found with a single KNN query.
+            num_crops = kwargs.get('num_crops', None)
+            rng = self.rng
+
+            center_idx = rng.integers(
+                len(pc), size=1 if num_crops is None else num_crops)
+            center_point = pc[center_idx, :]
 
             if (pc.shape[0] < num_points):
                 diff = num_points - pc.shape[0]
-                idxs = np.array(range(pc.shape[0]))
-                idxs = list(idxs) + list(random.choices(idxs, k=diff))
+                idxs = np.arange(pc.shape[0])
+                idxs = np.broadcast_to(idxs, (len(center_idx), len(idxs)))
+                extra = rng.integers(pc.shape[0], size=(len(center_idx), diff))
+                idxs = np.concatenate([idxs, extra], axis=1)
             else:
-                idxs = search_tree.query(center_point, k=num_points)[1][0]
-            random.shuffle(idxs)
+                idxs = search_tree.query(center_point, k=num_points)[1]
+            idxs = rng.permuted(idxs, axis=1)
             pc = pc[idxs]
+
+            if num_crops is None:
+                return pc[0], idxs[0], center_point
             return pc, idxs, center_point
 
         return _random_centered_gen
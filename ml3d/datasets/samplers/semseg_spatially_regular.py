@@ -1,57 +1,261 @@
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+import weakref
 import numpy as np
-from tqdm import tqdm
-import random
+from os.path import isdir, join
 
+from .base_sampler import BaseSampler
 from ...utils import SAMPLER
 
 
-class SemSegSpatiallyRegularSampler(object):
-    """Spatially regularSampler sampler for semantic segmentation datsets"""
+def _shared_array(size, dtype=np.float64):
+    """Allocate a zeroed array in memory shared with forked processes."""
+    dtype = np.dtype(dtype)
+    buf = mmap.mmap(-1, max(size * dtype.itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=size)
 
-    def __init__(self, dataset):
-        self.dataset = dataset
-        self.length = len(dataset)
-        self.split = self.dataset.split
 
-    def __len__(self):
-        return self.length
+def _remove_dir(path, pid):
+    # Forked workers inherit the finalizer, only the owner removes the dir.
+    if os.getpid() == pid:
+        shutil.rmtree(path, ignore_errors=True)
 
-    def initialize_with_dataloader(self, dataloader):
-        self.min_possibilities = []
-        self.possibilities = []
 
+class _BlockMin(object):
+    """Possibilities of a cloud with the minimum of each block of points kept.
+
+    The points are split into blocks of about sqrt(n) points, contiguous in a
+    spatial order such as the index array of the KD-tree, so that a crop only
+    touches a few blocks. The possibilities may only be changed through add(),
+    which updates the minimum of the blocks it affects. This way the argmin
+    costs O(sqrt(n)) instead of O(n).
+
+    All arrays are views into a byte buffer of get_nbytes(size) bytes given by
+    the sampler, which may be shared between processes.
+    """
+
+    def __init__(self, buf, size):
+        block_size = max(int(np.ceil(np.sqrt(size))), 1)
+        num_blocks = max(-(-size // block_size), 1)
+        self.block_size = block_size
+
+        arrays = []
+        offset = 0
+        for dtype, n in _BlockMin._get_layout(size):
+            arrays.append(np.frombuffer(buf, dtype, n, offset))
+            offset += np.dtype(dtype).itemsize * n
+        self.values_padded, self.block_min, self.block_argmin, \
+            order, self.block_of = arrays
+
+        # The last value is an inf sentinel, which pads the last block.
+        self.values = self.values_padded[:size]
+        self.order = order
+        self.blocks = order.reshape(num_blocks, block_size)
+
+    @staticmethod
+    def _get_layout(size):
+        block_size = max(int(np.ceil(np.sqrt(size))), 1)
+        num_blocks = max(-(-size // block_size), 1)
+        # Values, block_min, block_argmin, order and block_of, the 8 byte
+        # types first to keep the arrays aligned.
+        return [(np.float64, size + 1), (np.float64, num_blocks),
+                (np.int64, num_blocks), (np.int32, num_blocks * block_size),
+                (np.int32, size)]
+
+    @staticmethod
+    def get_nbytes(size):
+        nbytes = sum(
+            np.dtype(dtype).itemsize * n
+            for dtype, n in _BlockMin._get_layout(size))
+        return -(-nbytes // 8) * 8
+
+    def initialize(self, values, spatial_order=None):
+        size = self.values.shape[0]
+        self.values[:] = values
+        self.values_padded[size] = np.inf
+
+        self.order[:] = size
+        self.order[:size] = np.arange(
+            size) if spatial_order is None else spatial_order
+        self.block_of[self.order[:size]] = np.arange(size) // self.block_size
+        self._update_blocks(np.arange(self.block_min.shape[0]))
+
+    def argmin(self):
+        return int(self.block_argmin[np.argmin(self.block_min)])
+
+    def min(self):
+        return float(np.min(self.block_min))
+
+    def add(self, idxs, delta):
+        idxs = np.atleast_1d(idxs)
+        self.values[idxs] += delta
+
+        blocks = np.unique(self.block_of[idxs])
+        if np.min(delta) >= 0:
+            # Increasing values only moves the minimum of a block if the
+            # previous minimum was increased.
+            blocks = blocks[np.isin(self.block_argmin[blocks], idxs)]
+        self._update_blocks(blocks)
+
+    def _update_blocks(self, blocks):
+        inds = self.blocks[blocks]
+        values = self.values_padded[inds]
+        argmin = np.argmin(values, axis=1)
+        rows = np.arange(blocks.shape[0])
+        self.block_argmin[blocks] = inds[rows, argmin]
+        self.block_min[blocks] = values[rows, argmin]
+
+
+class SemSegSpatiallyRegularSampler(BaseSampler):
+    """Spatially regularSampler sampler for semantic segmentation datsets
+
+    The possibilities of the clouds are kept in shared memory, so the point
+    sampler may run in the worker processes of a dataloader. The cloud to
+    sample from is then passed as the `cloud_id` argument of the point sampler.
+    The minimum possibility of each block of points is tracked as crops are
+    sampled, so picking the next center doesn't scan the whole cloud.
+
+    A cloud is initialized by the point sampler when it is first visited.
+    With a cache, the point counts of its manifest size one shared buffer for
+    all clouds up front. Otherwise each cloud gets a file in a temporary dir
+    when it is first visited, which the other processes map.
+
+    The state of the sampler includes the possibilities of the visited clouds.
+    Those of clouds not visited yet are used when they are first visited.
+
+    The shared memory and the lock are inherited by forked processes only, so
+    the dataloader workers must use the 'fork' start method. The sampler
+    cannot be pickled once initialized, e.g. for spawned workers.
+    """
+
+    def __init__(self, dataset):
+        super().__init__(dataset)
+        self._loaded_possibilities = {}
+
+    def initialize_with_dataloader(self, dataloader):
         self.length = len(dataloader)
         dataset = self.dataset
+        num_clouds = len(dataset)
 
-        for index in range(len(dataset)):
-            attr = dataset.get_attr(index)
-            if dataloader.cache_convert:
-                data = dataloader.cache_convert(attr['name'])
-            elif dataloader.preprocess:
-                data = dataloader.preprocess(dataset.get_data(index), attr)
-            else:
-                data = dataset.get_data(index)
+        self.num_points = _shared_array(num_clouds, np.int64)
+        self.num_points[:] = -1
+        if dataloader.cache_convert:
+            for index in range(num_clouds):
+                n = dataloader.cache_convert.num_points(
+                    dataset.get_attr(index)['name'])
+                self.num_points[index] = -1 if n is None else n
+
+        self.min_possibilities = _shared_array(num_clouds)
+        self.initialized = _shared_array(num_clouds, np.bool_)
+        self.lock = multiprocessing.Lock()
+        self._clouds = {}
+
+        if np.all(self.num_points >= 0):
+            nbytes = [_BlockMin.get_nbytes(n) for n in self.num_points]
+            self._offsets = np.cumsum([0] + nbytes)
+            self._buf = _shared_array(int(self._offsets[-1]), np.uint8)
+            self._dir = None
+        else:
+            self._buf = None
+            self._dir = tempfile.mkdtemp(
+                prefix='possibilities_',
+                dir='/dev/shm' if isdir('/dev/shm') else None)
+            weakref.finalize(self, _remove_dir, self._dir, os.getpid())
+
+    def __getstate__(self):
+        if hasattr(self, 'lock'):
+            raise RuntimeError(
+                "SemSegSpatiallyRegularSampler shares its possibilities with "
+                "forked processes only, use the 'fork' start method for the "
+                "dataloader workers")
+        return self.__dict__
+
+    def get_possibilities(self, cloud_id):
+        """Get the possibilities of an initialized cloud."""
+        return self._get_cloud(cloud_id).values
+
+    def _get_cloud(self, cloud_id, pc=None, search_tree=None):
+        """Get the possibilities of a cloud, initializing it on first visit."""
+        cloud = self._clouds.get(cloud_id, None)
+        if cloud is not None and self.initialized[cloud_id]:
+            return cloud
 
-            pc = data['point']
-            self.possibilities += [np.random.rand(pc.shape[0]) * 1e-3]
-            self.min_possibilities += [float(np.min(self.possibilities[-1]))]
+        with self.lock:
+            if not self.initialized[cloud_id]:
+                if pc is None:
+                    raise KeyError(
+                        "Cloud {} is not initialized".format(cloud_id))
+                self.num_points[cloud_id] = pc.shape[0]
+            n = int(self.num_points[cloud_id])
+
+            if cloud is None:
+                if self._buf is not None:
+                    buf = self._buf[self._offsets[cloud_id]:self.
+                                    _offsets[cloud_id + 1]]
+                else:
+                    path = join(self._dir, '{}.bin'.format(cloud_id))
+                    mode = 'r+' if self.initialized[cloud_id] else 'w+'
+                    buf = np.memmap(path,
+                                    dtype=np.uint8,
+                                    mode=mode,
+                                    shape=(_BlockMin.get_nbytes(n),))
+                cloud = _BlockMin(buf, n)
+                self._clouds[cloud_id] = cloud
+
+            if not self.initialized[cloud_id]:
+                spatial_order = None
+                if search_tree is not None:
+                    spatial_order = search_tree.get_arrays()[1]
+                values = self._loaded_possibilities.pop(cloud_id, None)
+                if values is None or values.shape[0] != n:
+                    values = self.rng.random(n) * 1e-3
+                cloud.initialize(values, spatial_order)
+                self.min_possibilities[cloud_id] = cloud.min()
+                self.initialized[cloud_id] = True
+
+        return cloud
+
+    def state_dict(self):
+        state_dict = super().state_dict()
+        state_dict['possibilities'] = {
+            int(cloud_id): self.get_possibilities(cloud_id).copy()
+            for cloud_id in np.flatnonzero(self.initialized)
+        }
+        state_dict['min_possibilities'] = self.min_possibilities.copy()
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        for cloud_id, values in state_dict['possibilities'].items():
+            if self.initialized[cloud_id]:
+                cloud = self._get_cloud(cloud_id)
+                with self.lock:
+                    cloud.initialize(values, cloud.order[:len(values)].copy())
+            else:
+                self._loaded_possibilities[cloud_id] = values
+        self.min_possibilities[:] = state_dict['min_possibilities']
 
     def get_cloud_sampler(self):
 
+        # With several ranks, each samples its own part of the clouds.
+        cloud_ids = np.arange(len(self.min_possibilities))
+        if len(cloud_ids) >= self.world_size:
+            cloud_ids = cloud_ids[self.rank::self.world_size]
+
         def gen_train():
-            for i in range(self.length):
-                self.cloud_id = int(np.argmin(self.min_possibilities))
+            for i in range(len(self)):
+                self.cloud_id = int(cloud_ids[np.argmin(
+                    self.min_possibilities[cloud_ids])])
                 yield self.cloud_id
 
         def gen_test():
-            curr_could_id = 0
-            while curr_could_id < self.length:
-                if self.min_possibilities[curr_could_id] > 0.5:
-                    curr_could_id = curr_could_id + 1
-                    continue
-                self.cloud_id = curr_could_id
-
-                yield self.cloud_id
+            for curr_could_id in cloud_ids[cloud_ids < self.length]:
+                while self.min_possibilities[curr_could_id] <= 0.5:
+                    self.cloud_id = int(curr_could_id)
+                    yield self.cloud_id
 
         if self.split in ['train', 'validation', 'valid', 'training']:
             gen = gen_train
@@ -72,33 +276,57 @@ class SemSegSpatiallyRegularSampler(object):
                     "Please provide pc, num_points, and (search_tree or radius) \
                     for point_sampler in SemSegSpatiallyRegularSampler")
 
-            cloud_id = self.cloud_id
+            num_crops = kwargs.pop('num_crops', None)
+            if num_crops is not None:
+                # Each center depends on the possibilities updated by the
+                # previous crop, so the crops are drawn one after another.
+                crops = [
+                    _random_centered_gen(**kwargs) for _ in range(num_crops)
+                ]
+                pcs, idxs, centers = zip(*crops)
+                return list(pcs), list(idxs), np.concatenate(centers)
+
+            cloud_id = kwargs.get('cloud_id', None)
+            if cloud_id is None:
+                cloud_id = self.cloud_id
+            possibility = self._get_cloud(cloud_id, pc, search_tree)
+
             n = 0
             while n < 2:
-                center_id = np.argmin(self.possibilities[cloud_id])
+                # Reserve the center, so that concurrent workers sampling the
+                # same cloud pick different centers while the search runs.
+                with self.lock:
+                    center_id = possibility.argmin()
+                    possibility.add(center_id, 1.0)
                 center_point = pc[center_id, :].reshape(1, -1)
 
                 if radius is not None:
                     idxs = search_tree.query_radius(center_point, r=radius)[0]
                 elif num_points is not None:
                     if (pc.shape[0] < num_points):
-                        idxs = np.array(range(pc.shape[0]))
-                        idxs = list(idxs) + list(random.choices(idxs, k=diff))
+                        diff = num_points - pc.shape[0]
+                        idxs = np.concatenate([
+                            np.arange(pc.shape[0]),
+                            self.rng.integers(pc.shape[0], size=diff)
+                        ])
                     else:
                         idxs = search_tree.query(center_point,
                                                  k=num_points)[1][0]
                 n = len(idxs)
                 if n < 2:
-                    self.possibilities[cloud_id][center_id] += 0.001
+                    with self.lock:
+                        possibility.add(center_id, 0.001 - 1.0)
 
-            random.shuffle(idxs)
+            idxs = self.rng.permutation(idxs)
             pc = pc[idxs]
             dists = np.sum(np.square((pc - center_point).astype(np.float32)),
                            axis=1)
             delta = np.square(1 - dists / np.max(dists))
-            self.possibilities[cloud_id][idxs] += delta
-            new_min = float(np.min(self.possibilities[cloud_id]))
-            self.min_possibilities[cloud_id] = new_min
+            with self.lock:
+                # The center gets a delta of 1, which replaces its reservation.
+                possibility.add(center_id, -1.0)
+                possibility.add(idxs, delta)
+                self.min_possibilities[cloud_id] = possibility.min()
 
             return pc, idxs, center_point
 
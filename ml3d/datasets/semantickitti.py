@@ -207,8 +207,9 @@ class SemanticKITTI(BaseDataset):
 
             test_file_name = name_points
 
-            proj_inds = inputs['data'].reproj_inds[0]
-            probs = results[proj_inds, :]
+            # The pipeline already projects the probabilities on the
+            # original points.
+            probs = results
 
             pred = np.argmax(probs, 1)
 
@@ -2,6 +2,7 @@ import numpy as np
 import os, argparse, pickle, sys
 import open3d.core as o3c
 
+from scipy.spatial import cKDTree
 from os.path import exists, join, isfile, dirname, abspath, split
 from open3d.ml.contrib import subsample
 from open3d.ml.contrib import knn_search
@@ -97,6 +98,93 @@ class DataProcessing:
 
         return neighbor_idx.astype(np.int32)
 
+    @staticmethod
+    def knn_hierarchy(points, k, sub_sampling_ratio, num_candidates=None):
+        """
+        Neighbors of all layers of a batch of point clouds, where the points
+        of each layer are the first points of the previous layer.
+
+        The clouds are moved apart and searched together, with one tree per
+        layer. The neighbors of a layer are searched once, as num_candidates
+        candidates per point. Filtered to the points kept in the next layer,
+        they give the up-sampling indices and, where at least k remain, the
+        neighbors of the next layer. Only the other points are searched in the
+        tree of the next layer, so the results are exact.
+
+        :param points: points of the clouds, B*N*3
+        :param k: Number of neighbours in the knn search of each layer
+        :param sub_sampling_ratio: ratio of the number of points of each layer
+            to the next one, one entry per layer
+        :param num_candidates: number of candidates searched per point, at
+            least k. More candidates leave fewer points to search again.
+        :return: lists with an entry per layer of the points B*N_l*3, the
+            neighbor indices B*N_l*k, the pooling indices B*N_(l+1)*k and the
+            up-sampling indices B*N_l*1, all indices int64
+        """
+        points = np.asarray(points)
+        batch_size = points.shape[0]
+        num_candidates = max(k, num_candidates or k)
+
+        # Shift the clouds along x so that the knn of a point, which is
+        # within the diameter of its cloud, never reaches another cloud.
+        mins = points.min(axis=1, keepdims=True)
+        diameter = np.linalg.norm(points.max(axis=1) - mins[:, 0], axis=1)
+        shift = np.zeros((batch_size, 1, 3))
+        shift[:, 0, 0] = np.arange(batch_size) * (2 * diameter.max() + 1)
+        shifted = points - mins + shift
+
+        def query(tree, num_points, rows, cols, num):
+            # Indices in their cloud of the num nearest points of a layer.
+            idx = tree.query(shifted[rows, cols], k=[*range(1, num + 1)])[1]
+            return idx - rows[:, None] * num_points
+
+        input_points = []
+        input_neighbors = []
+        input_pools = []
+        input_up_samples = []
+
+        num_points = points.shape[1]
+        tree = cKDTree(shifted.reshape(-1, 3))
+        rows, cols = np.indices((batch_size, num_points)).reshape(2, -1)
+        candidates = query(tree, num_points, rows, cols,
+                           min(num_candidates, num_points))
+        candidates = candidates.reshape(batch_size, num_points, -1)
+
+        for ratio in sub_sampling_ratio:
+            num_sub = num_points // ratio
+            sub_tree = cKDTree(shifted[:, :num_sub].reshape(-1, 3))
+            in_sub = candidates < num_sub
+
+            # The nearest point of the sub layer is the first candidate in it.
+            up_idx = np.take_along_axis(candidates,
+                                        np.argmax(in_sub, axis=2)[..., None],
+                                        axis=2)
+            rows, cols = np.nonzero(~np.any(in_sub, axis=2))
+            up_idx[rows, cols] = query(sub_tree, num_sub, rows, cols, 1)
+
+            neighbor_idx = np.ascontiguousarray(candidates[:, :, :k])
+            input_points.append(points[:, :num_points])
+            input_neighbors.append(neighbor_idx)
+            input_pools.append(neighbor_idx[:, :num_sub])
+            input_up_samples.append(up_idx)
+            if len(input_points) == len(sub_sampling_ratio):
+                break
+
+            # Candidates of the sub layer, those in it first and in order.
+            order = np.argsort(~in_sub[:, :num_sub], axis=2, kind='stable')
+            sub_candidates = np.take_along_axis(candidates[:, :num_sub],
+                                                order,
+                                                axis=2)
+            sub_candidates = sub_candidates[:, :, :min(num_candidates, num_sub)]
+            rows, cols = np.nonzero(np.sum(in_sub[:, :num_sub], axis=2) < k)
+            sub_candidates[rows, cols] = query(sub_tree, num_sub, rows, cols,
+                                               sub_candidates.shape[2])
+
+            num_points = num_sub
+            candidates = sub_candidates
+
+        return input_points, input_neighbors, input_pools, input_up_samples
+
     @staticmethod
     def data_aug(xyz, color, labels, idx, num_out):
         num_in = len(xyz)
@@ -135,7 +135,8 @@ class ObjdetAugmentation():
 
     @staticmethod
     def PointShuffle(data):
-        np.random.shuffle(data['point'])
+        # Not in place, the points may be a read-only cached array.
+        data['point'] = np.random.permutation(data['point'])
 
         return data
 
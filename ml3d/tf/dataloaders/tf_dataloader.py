@@ -1,12 +1,11 @@
 from abc import abstractmethod
-from tqdm import tqdm
 from os.path import exists, join, isfile, dirname, abspath, split
 from pathlib import Path
 import random
 
 import tensorflow as tf
 import numpy as np
-from ...utils import Cache, get_hash
+from ...utils import Cache, get_cache_key
 
 from ...datasets.utils import DataProcessing
 from sklearn.neighbors import KDTree
@@ -52,7 +51,7 @@ class TFDataloader():
             dataset: The 3D ML dataset class. You can use the base dataset, sample datasets , or a custom dataset.
             preprocess: The model's preprocess method.
             transform: The model's transform method.
-            use_cache: Indicates if preprocessed data should be cached.
+            use_cache: Indicates if preprocessed data should be cached, as configured by the dataset (see BaseDataset).
 			get_batch_gen: <NTD>
 			model_cfg: The configuration file of the model.
             steps_per_epoch: The number of steps per epoch that indicates the bactches of samples to train. If it is None, then the step number will be the number of samples in the data.
@@ -80,23 +79,17 @@ class TFDataloader():
 
             assert cache_dir is not None, 'cache directory is not given'
 
-            self.cache_convert = Cache(self.preprocess,
-                                       cache_dir=cache_dir,
-                                       cache_key=get_hash(
-                                           repr(self.preprocess)[:-15]))
+            self.cache_convert = Cache(
+                self.preprocess,
+                cache_dir=cache_dir,
+                cache_key=get_cache_key(self.preprocess),
+                mem_size=dataset.cfg.get('cache_mem_size', 0),
+                shm_dir=dataset.cfg.get('cache_shm_dir', None))
 
-            uncached = [
-                idx for idx in range(len(dataset)) if dataset.get_attr(idx)
-                ['name'] not in self.cache_convert.cached_ids
-            ]
-            if len(uncached) > 0:
-                print("cache key : {}".format(repr(self.preprocess)[:-15]))
-                for idx in tqdm(range(len(dataset)), desc='preprocess'):
-                    attr = dataset.get_attr(idx)
-                    data = dataset.get_data(idx)
-                    name = attr['name']
-
-                    self.cache_convert(name, data, attr)
+            self.cache_convert.warmup(
+                dataset,
+                num_workers=dataset.cfg.get('preprocess_workers', 0),
+                check_stale=dataset.cfg.get('cache_check_stale', False))
 
         else:
             self.cache_convert = None
@@ -114,7 +107,8 @@ class TFDataloader():
 		"""
         attr = self.dataset.get_attr(index)
         if self.cache_convert:
-            data = self.cache_convert(attr['name'])
+            data = self.cache_convert(attr['name'],
+                                      source_path=attr.get('path', None))
         elif self.preprocess:
             data = self.preprocess(self.dataset.get_data(index), attr)
         else:
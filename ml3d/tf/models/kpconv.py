@@ -26,6 +26,9 @@ class KPFCNN(BaseModel):
     Class defining KPFCNN. A model for Semantic Segmentation.
     """
 
+    # Config fields the output of preprocess depends on, used in the cache key.
+    preprocess_cfg_keys = ['first_subsampling_dl']
+
     def __init__(
             self,
             name='KPFCNN',
@@ -971,6 +974,9 @@ class KPFCNN(BaseModel):
                 # Collect points and colors
                 input_points = points[input_inds].copy() - pick_point
                 feat = data['feat']
+                if feat is not None:
+                    # Normalize the crop only, cached arrays are read-only.
+                    feat = feat[input_inds]
 
                 t_normalize = self.cfg.get('t_normalize', {})
                 input_points, feat = trans_normalize(input_points, feat,
@@ -979,7 +985,7 @@ class KPFCNN(BaseModel):
                 if feat is None:
                     coords = input_points.copy()
                 else:
-                    coords = np.hstack((input_points, feat[input_inds]))
+                    coords = np.hstack((input_points, feat))
 
                 coords[:, 2] += pick_point[:, 2]
 
@@ -38,6 +38,9 @@ class PointPillars(BaseModel):
         head: Config of anchor head module.
     """
 
+    # Config fields the output of preprocess depends on, used in the cache key.
+    preprocess_cfg_keys = ['point_cloud_range']
+
     def __init__(self,
                  name="PointPillars",
                  point_cloud_range=[0, -40.0, -3, 70.0, 40.0, 1],
@@ -18,6 +18,9 @@ from ...datasets.utils import (DataProcessing, trans_normalize, trans_augment,
 
 class RandLANet(BaseModel):
 
+    # Config fields the output of preprocess depends on, used in the cache key.
+    preprocess_cfg_keys = ['grid_size', 't_align']
+
     def __init__(
             self,
             name='RandLANet',
@@ -1,8 +1,11 @@
 """Dataloader for PyTorch."""
 
-from .torch_dataloader import TorchDataloader
+from .torch_dataloader import TorchDataloader, worker_init_fn
 from .torch_sampler import get_sampler
 from .default_batcher import DefaultBatcher
-from .concat_batcher import ConcatBatcher
+from .concat_batcher import ConcatBatcher, PackedBatches
 
-__all__ = ['TorchDataloader', 'DefaultBatcher', 'ConcatBatcher', 'get_sampler']
+__all__ = [
+    'TorchDataloader', 'DefaultBatcher', 'ConcatBatcher', 'PackedBatches',
+    'get_sampler', 'worker_init_fn'
+]
@@ -3,15 +3,42 @@ import time
 import numpy as np
 import pickle
 import torch
+import torch.distributed as dist
 import yaml
 from os import listdir
 from os.path import exists, join, isdir
 
-from ..models.kpconv import batch_grid_subsampling, batch_neighbors
-
 from torch.utils.data import Sampler, get_worker_info
 
 
+def concat_indices(indices, num_supports):
+    """
+    Concatenate the neighbor indices of several samples.
+
+    Args:
+        indices: list of (N_i, K_i) neighbor indices of each sample, with
+            num_supports[i] as shadow index.
+        num_supports: list of the number of support points of each sample.
+
+    Returns:
+        (sum N_i, max K_i) neighbor indices into the concatenated supports,
+        padded with the total number of supports.
+    """
+    total = sum(num_supports)
+    width = max(x.shape[1] for x in indices)
+    out = np.full((sum(x.shape[0] for x in indices), width),
+                  total,
+                  dtype=np.int64)
+    i0 = 0
+    offset = 0
+    for x, n in zip(indices, num_supports):
+        out[i0:i0 + x.shape[0], :x.shape[1]] = np.where(x < n, x + offset,
+                                                        total)
+        i0 += x.shape[0]
+        offset += n
+    return out
+
+
 class CustomBatch:
     """Batched results for KPConv"""
 
@@ -26,7 +53,6 @@ class CustomBatch:
             class: The corresponding class.
         """
 
-        self.neighborhood_limits = []
         p_list = []
         f_list = []
         l_list = []
@@ -34,9 +60,8 @@ class CustomBatch:
         p0_list = []
         s_list = []
         R_list = []
-        r_inds_list = []
         r_mask_list = []
-        val_labels_list = []
+        layers_list = []
         batch_n = 0
 
         self.cfg = batches[0]['data']['cfg']
@@ -48,7 +73,8 @@ class CustomBatch:
 
             for p in data['p_list']:
                 batch_n += p.shape[0]
-            if batch_n > batch_limit:
+            # The first sample is kept even if it is over the limit.
+            if batch_n > batch_limit and len(p_list) > 0:
                 break
 
             p_list += data['p_list']
@@ -57,9 +83,8 @@ class CustomBatch:
             p0_list += data['p0_list']
             s_list += data['s_list']
             R_list += data['R_list']
-            r_inds_list += data['r_inds_list']
             r_mask_list += data['r_mask_list']
-            val_labels_list += data['val_labels_list']
+            layers_list += [data['layers']]
 
         ###################
         # Concatenate batch
@@ -70,7 +95,6 @@ class CustomBatch:
         labels = np.concatenate(l_list, axis=0)
         frame_inds = np.array(fi_list, dtype=np.int32)
         frame_centers = np.stack(p0_list, axis=0)
-        stack_lengths = np.array([pp.shape[0] for pp in p_list], dtype=np.int32)
         scales = np.array(s_list, dtype=np.float32)
         rots = np.stack(R_list, axis=0)
 
@@ -110,200 +134,76 @@ class CustomBatch:
         # Create network inputs
         #######################
         #
-        #   Points, neighbors, pooling indices for each layers
+        #   Points, neighbors, pooling indices for each layers, computed for
+        #   each sample by the transform of the model
         #
 
-        # Get the whole input list
-        input_list = self.segmentation_inputs(stacked_points, stacked_features,
-                                              labels.astype(np.int64),
-                                              stack_lengths)
-
-        # Add scale and rotation for testing
-        input_list += [
-            scales, rots, frame_inds, frame_centers, r_inds_list, r_mask_list,
-            val_labels_list
-        ]
+        layers = self.concat_layers(layers_list)
 
-        input_list = [self.cfg.num_layers] + input_list
-
-        # Number of layers
-        L = int(input_list[0])
-
-        # Extract input tensors from the list of numpy array
-        ind = 1
         self.points = [
-            torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]
+            torch.from_numpy(nparray) for nparray in layers['points']
         ]
-        ind += L
         self.neighbors = [
-            torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]
-        ]
-
-        ind += L
-        self.pools = [
-            torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]
+            torch.from_numpy(nparray) for nparray in layers['neighbors']
         ]
-        ind += L
+        self.pools = [torch.from_numpy(nparray) for nparray in layers['pools']]
         self.upsamples = [
-            torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]
+            torch.from_numpy(nparray) for nparray in layers['upsamples']
         ]
-        ind += L
         self.lengths = [
-            torch.from_numpy(nparray) for nparray in input_list[ind:ind + L]
+            torch.from_numpy(nparray) for nparray in layers['lengths']
         ]
-        ind += L
-        self.features = torch.from_numpy(input_list[ind])
-        ind += 1
-        self.labels = torch.from_numpy(input_list[ind])
-        ind += 1
-        self.scales = torch.from_numpy(input_list[ind])
-        ind += 1
-        self.rots = torch.from_numpy(input_list[ind])
-        ind += 1
-        self.frame_inds = torch.from_numpy(input_list[ind])
-        ind += 1
-        self.frame_centers = torch.from_numpy(input_list[ind])
-        ind += 1
-        self.reproj_inds = input_list[ind]
-        ind += 1
-        self.reproj_masks = input_list[ind]
-        ind += 1
-        self.val_labels = input_list[ind]
+        self.features = torch.from_numpy(stacked_features)
+        self.labels = torch.from_numpy(labels.astype(np.int64))
+        self.scales = torch.from_numpy(scales)
+        self.rots = torch.from_numpy(rots)
+        self.frame_inds = torch.from_numpy(frame_inds)
+        self.frame_centers = torch.from_numpy(frame_centers)
+        self.reproj_masks = r_mask_list
 
         return
 
-    def big_neighborhood_filter(self, neighbors, layer):
+    @staticmethod
+    def concat_layers(layers_list):
         """
-        Filter neighborhoods with max number of neighbors. Limit is set to keep XX% of the neighborhoods untouched.
-        Limit is computed at initialization
-        """
-
-        # crop neighbors matrix
-        if len(self.neighborhood_limits) > 0:
-            return neighbors[:, :self.neighborhood_limits[layer]]
-        else:
-            return neighbors
-
-    def segmentation_inputs(self, stacked_points, stacked_features, labels,
-                            stack_lengths):
-
-        # Starting radius of convolutions
-        r_normal = self.cfg.first_subsampling_dl * self.cfg.conv_radius
-
-        # Starting layer
-        layer_blocks = []
-
-        # Lists of inputs
-        input_points = []
-        input_neighbors = []
-        input_pools = []
-        input_upsamples = []
-        input_stack_lengths = []
-        deform_layers = []
-
-        ######################
-        # Loop over the blocks
-        ######################
-
-        arch = self.cfg.architecture
+        Concatenate the layers of the samples of a batch.
 
-        for block_i, block in enumerate(arch):
-
-            # Get all blocks of the layer
-            if not ('pool' in block or 'strided' in block or
-                    'global' in block or 'upsample' in block):
-                layer_blocks += [block]
-                continue
-
-            # Convolution neighbors indices
-            # *****************************
-
-            deform_layer = False
-            if layer_blocks:
-                # Convolutions are done in this layer, compute the neighbors with the good radius
-                if np.any(['deformable' in blck for blck in layer_blocks]):
-                    r = r_normal * self.cfg.deform_radius / self.cfg.conv_radius
-                    deform_layer = True
-                else:
-                    r = r_normal
-                conv_i = batch_neighbors(stacked_points, stacked_points,
-                                         stack_lengths, stack_lengths, r)
-
-            else:
-                # This layer only perform pooling, no neighbors required
-                conv_i = np.zeros((0, 1), dtype=np.int32)
-
-            # Pooling neighbors indices
-            # *************************
-
-            # If end of layer is a pooling operation
-            if 'pool' in block or 'strided' in block:
-
-                # New subsampling length
-                dl = 2 * r_normal / self.cfg.conv_radius
-
-                # Subsampled points
-                pool_p, pool_b = batch_grid_subsampling(stacked_points,
-                                                        stack_lengths,
-                                                        sampleDl=dl)
-
-                # Radius of pooled neighbors
-                if 'deformable' in block:
-                    r = r_normal * self.cfg.deform_radius / self.cfg.conv_radius
-                    deform_layer = True
-                else:
-                    r = r_normal
-
-                # Subsample indices
-                pool_i = batch_neighbors(pool_p, stacked_points, pool_b,
-                                         stack_lengths, r)
-
-                # Upsample indices (with the radius of the next layer to keep wanted density)
-                up_i = batch_neighbors(stacked_points, pool_p, stack_lengths,
-                                       pool_b, 2 * r)
-
-            else:
-                # No pooling in the end of this layer, no pooling indices required
-                pool_i = np.zeros((0, 1), dtype=np.int32)
-                pool_p = np.zeros((0, 3), dtype=np.float32)
-                pool_b = np.zeros((0,), dtype=np.int32)
-                up_i = np.zeros((0, 1), dtype=np.int32)
-
-            # Reduce size of neighbors matrices by eliminating furthest point
-            conv_i = self.big_neighborhood_filter(conv_i, len(input_points))
-            pool_i = self.big_neighborhood_filter(pool_i, len(input_points))
-            if up_i.shape[0] > 0:
-                up_i = self.big_neighborhood_filter(up_i, len(input_points) + 1)
-
-            # Updating input lists
-            input_points += [stacked_points]
-            input_neighbors += [conv_i.astype(np.int64)]
-            input_pools += [pool_i.astype(np.int64)]
-            input_upsamples += [up_i.astype(np.int64)]
-            input_stack_lengths += [stack_lengths]
-            deform_layers += [deform_layer]
-
-            # New points for next layer
-            stacked_points = pool_p
-            stack_lengths = pool_b
-
-            # Update radius and reset blocks
-            r_normal *= 2
-            layer_blocks = []
-
-            # Stop when meeting a global pooling or upsampling
-            if 'global' in block or 'upsample' in block:
-                break
-
-        ###############
-        # Return inputs
-        ###############
-
-        # list of network inputs
-        li = input_points + input_neighbors + input_pools + input_upsamples + input_stack_lengths
-        li += [stacked_features, labels]
-
-        return li
+        The indices of each sample are shifted by the number of points of the
+        samples before it, and its shadow neighbors (the number of points of
+        the sample) are mapped to the number of points of the batch.
+        """
+        layers = {
+            'points': [],
+            'neighbors': [],
+            'pools': [],
+            'upsamples': [],
+            'lengths': []
+        }
+        num_layers = len(layers_list[0]['points'])
+        for layer in range(num_layers):
+            points = [x['points'][layer] for x in layers_list]
+            layers['points'].append(np.concatenate(points, axis=0))
+            layers['lengths'].append(
+                np.concatenate([x['lengths'][layer] for x in layers_list]))
+
+            # Neighbors and pools index the points of the layer, upsamples
+            # the points of the next layer.
+            supports = [p.shape[0] for p in points]
+            layers['neighbors'].append(
+                concat_indices([x['neighbors'][layer] for x in layers_list],
+                               supports))
+            layers['pools'].append(
+                concat_indices([x['pools'][layer] for x in layers_list],
+                               supports))
+            if layer + 1 < num_layers:
+                supports = [
+                    x['points'][layer + 1].shape[0] for x in layers_list
+                ]
+            layers['upsamples'].append(
+                concat_indices([x['upsamples'][layer] for x in layers_list],
+                               supports))
+
+        return layers
 
     def pin_memory(self):
         """
@@ -407,32 +307,170 @@ class CustomBatch:
         return all_p_list
 
 
+class ObjectDetectBatch:
+    """Batched results for object detection models, e.g. PointPillars"""
+
+    def __init__(self, batches):
+        """
+        Initialize
+
+        Args:
+            batches: A batch of data
+
+        Returns:
+            class: The corresponding class.
+        """
+        self.point = []
+        self.labels = []
+        self.bboxes = []
+        self.bbox_objs = []
+        self.calib = []
+        self.attr = []
+
+        # The point clouds and boxes of the samples have different sizes and
+        # are kept as lists of tensors.
+        for batch in batches:
+            data = batch['data']
+            self.attr.append(batch['attr'])
+            self.point.append(
+                torch.from_numpy(np.array(data['point'], dtype=np.float32)))
+            if 'labels' in data:
+                self.labels.append(
+                    torch.from_numpy(np.array(data['labels'], dtype=np.int64)))
+                self.bboxes.append(
+                    torch.from_numpy(np.array(data['bboxes'],
+                                              dtype=np.float32)))
+            self.bbox_objs.append(data.get('bbox_objs', None))
+            self.calib.append(data.get('calib', None))
+
+    def pin_memory(self):
+        self.point = [pc.pin_memory() for pc in self.point]
+        self.labels = [label.pin_memory() for label in self.labels]
+        self.bboxes = [bbox.pin_memory() for bbox in self.bboxes]
+
+        return self
+
+    def to(self, device):
+        self.point = [pc.to(device) for pc in self.point]
+        self.labels = [label.to(device) for label in self.labels]
+        self.bboxes = [bbox.to(device) for bbox in self.bboxes]
+
+        return self
+
+
+class PackedBatches(object):
+    """
+    Batches of a DataLoader packed up to the batch_limit of the model.
+
+    The DataLoader collates its samples with list. The samples are then
+    packed into batches of at most batch_limit points, so that none of them
+    is dropped by CustomBatch. A batch is complete when the next sample
+    would go over the limit, a sample over the limit makes a batch on its
+    own. The number of batches thus depends on the sizes of the samples and
+    is only known at the end of an epoch, so PackedBatches has no length.
+
+    The batches are collated in the main process. They are pinned before
+    they are moved to the device if the DataLoader pins its memory.
+    """
+
+    def __init__(self, loader, batcher, even_steps=False):
+        """
+        Initialize
+
+        Args:
+            loader: DataLoader with list as collate_fn.
+            batcher: ConcatBatcher collating the packed batches.
+            even_steps: Stop when the first rank of the default process
+                group runs out of batches, so that all ranks take the same
+                number of steps, e.g. for DistributedDataParallel.
+        """
+        self.loader = loader
+        self.batcher = batcher
+        self.generator = loader.generator
+        self.even_steps = even_steps and dist.is_available() and \
+            dist.is_initialized() and dist.get_world_size() > 1
+
+    def pack(self):
+        """Generate the packed batches of this rank."""
+        samples = []
+        batch_n = 0
+        for batch in self.loader:
+            for sample in batch:
+                data = sample['data']
+                n = sum(p.shape[0] for p in data['p_list'])
+                if samples and batch_n + n > int(data['cfg'].batch_limit):
+                    yield self.batcher.collate_fn(
+                        samples, pin_memory=self.loader.pin_memory)
+                    samples = []
+                    batch_n = 0
+                samples.append(sample)
+                batch_n += n
+
+        if samples:
+            yield self.batcher.collate_fn(samples,
+                                          pin_memory=self.loader.pin_memory)
+
+    def __iter__(self):
+        batches = self.pack()
+        if not self.even_steps:
+            yield from batches
+            return
+
+        # The ranks agree at each step on whether they all have a batch.
+        for batch in batches:
+            if not self.all_ranks_have_batch(True):
+                return
+            yield batch
+        self.all_ranks_have_batch(False)
+
+    def all_ranks_have_batch(self, has_batch):
+        has_batch = torch.tensor(int(has_batch), device=self.batcher.device)
+        dist.all_reduce(has_batch, op=dist.ReduceOp.MIN)
+        return bool(has_batch.item())
+
+
 class ConcatBatcher(object):
-    """ConcatBatcher for KPConv"""
+    """ConcatBatcher for KPConv and PointPillars"""
 
-    def __init__(self, device):
+    def __init__(self, device, model='KPConv'):
         """
         Initialize
 
         Args:
             device: torch device 'gpu' or 'cpu'
+            model: The name of the model the batches are collated for.
 
         Returns:
             class: The corresponding class.
         """
         super(ConcatBatcher, self).__init__()
         self.device = device
+        self.model = model
 
-    def collate_fn(self, batches):
+    def collate_fn(self, batches, pin_memory=False):
         """
         collate_fn called by original PyTorch dataloader
 
         Args:
             batches: a batch of data
+            pin_memory: Pin a batch collated in the main process before it is
+                moved to the device.
 
         Returns:
             class: the batched result
         """
+        if self.model == 'PointPillars':
+            # Moved to the device by the pipeline, after pinning.
+            return ObjectDetectBatch(batches)
+
         batching_result = CustomBatch(batches)
-        batching_result.to(self.device)
-        return {'data': batching_result, 'attr': []}
+        # Dataloader workers keep the batch on the host, it is moved to the
+        # device by the model.
+        if get_worker_info() is None:
+            if pin_memory:
+                batching_result.pin_memory()
+            batching_result.to(self.device)
+        return {
+            'data': batching_result,
+            'attr': [batch['attr'] for batch in batches]
+        }
@@ -88,6 +88,13 @@ class DefaultBatcher(object):
         super(DefaultBatcher, self).__init__()
 
     def collate_fn(self, batch):
+        # A sample holding the data of several crops adds each crop to the
+        # batch.
+        batch = [{
+            'data': data,
+            'attr': b['attr']
+        } for b in batch for data in (
+            b['data'] if isinstance(b['data'], list) else [b['data']])]
         batching_result = default_collate(batch)
 
         return batching_result
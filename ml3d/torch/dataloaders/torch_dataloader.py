@@ -1,11 +1,10 @@
 from abc import abstractmethod
-from tqdm import tqdm
+import numpy as np
 import torch
-from torch.multiprocessing import Pool
 from torch.utils.data import Dataset
 from collections import namedtuple
 
-from ...utils import Cache, get_hash
+from ...utils import Cache, get_cache_key
 
 
 class TorchDataloader(Dataset):
@@ -39,7 +38,7 @@ class TorchDataloader(Dataset):
             dataset: The 3D ML dataset class. You can use the base dataset, sample datasets , or a custom dataset.
             preprocess: The model's preprocess method.
             transform: The model's transform method.
-            use_cache: Indicates if preprocessed data should be cached.
+            use_cache: Indicates if preprocessed data should be cached, as configured by the dataset (see BaseDataset).
             steps_per_epoch: The number of steps per epoch that indicates the bactches of samples to train. If it is None, then the step number will be the number of samples in the data.
         Returns:
             class: The corresponding class.
@@ -52,29 +51,24 @@ class TorchDataloader(Dataset):
             cache_dir = getattr(dataset.cfg, 'cache_dir')
             assert cache_dir is not None, 'cache directory is not given'
 
-            self.cache_convert = Cache(preprocess,
-                                       cache_dir=cache_dir,
-                                       cache_key=get_hash(repr(preprocess)))
-
-            uncached = [
-                idx for idx in range(len(dataset)) if dataset.get_attr(idx)
-                ['name'] not in self.cache_convert.cached_ids
-            ]
-            if len(uncached) > 0:
-                for idx in tqdm(range(len(dataset)), desc='preprocess'):
-                    attr = dataset.get_attr(idx)
-                    name = attr['name']
-                    if name in self.cache_convert.cached_ids:
-                        continue
-                    data = dataset.get_data(idx)
-                    # cache the data
-                    self.cache_convert(name, data, attr)
+            self.cache_convert = Cache(
+                preprocess,
+                cache_dir=cache_dir,
+                cache_key=get_cache_key(preprocess),
+                mem_size=dataset.cfg.get('cache_mem_size', 0),
+                shm_dir=dataset.cfg.get('cache_shm_dir', None))
+
+            self.cache_convert.warmup(
+                dataset,
+                num_workers=dataset.cfg.get('preprocess_workers', 0),
+                check_stale=dataset.cfg.get('cache_check_stale', False))
 
         else:
             self.cache_convert = None
 
         self.transform = transform
 
+        self.sampler = sampler
         if sampler is not None:
             sampler.initialize_with_dataloader(self)
 
@@ -87,7 +81,8 @@ class TorchDataloader(Dataset):
 
         attr = dataset.get_attr(index)
         if self.cache_convert:
-            data = self.cache_convert(attr['name'])
+            data = self.cache_convert(attr['name'],
+                                      source_path=attr.get('path', None))
         elif self.preprocess:
             data = self.preprocess(dataset.get_data(index), attr)
         else:
@@ -107,3 +102,17 @@ class TorchDataloader(Dataset):
         else:
             steps_per_epoch = len(self.dataset)
         return steps_per_epoch
+
+
+def worker_init_fn(worker_id):
+    """Seed numpy and the sampler of a TorchDataloader in a dataloader worker.
+
+    The seed torch gives each worker is drawn from the generator of the
+    DataLoader, so seeding that makes the crops and the augmentations of the
+    workers reproducible, and different between the workers.
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    np.random.seed(worker_info.seed % 2**32)
+    sampler = getattr(worker_info.dataset, 'sampler', None)
+    if sampler is not None and hasattr(sampler, 'set_seed'):
+        sampler.set_seed(worker_info.seed)
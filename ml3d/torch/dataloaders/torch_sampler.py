@@ -1,4 +1,5 @@
 import torch
+import torch.distributed as dist
 from torch.utils.data import Sampler
 
 
@@ -15,5 +16,23 @@ class TorchSamplerWrapper(Sampler):
         return len(self.sampler)
 
 
+class DistributedSamplerWrapper(TorchSamplerWrapper):
+    """Sampler wrapper sharding the samples across the ranks of the default
+    process group.
+
+    The sampler is reseeded with a seed of rank 0, so that all ranks draw the
+    same samples, and then sharded so that each rank keeps its own part.
+    """
+
+    def __init__(self, sampler):
+        super().__init__(sampler)
+        seed = [int(sampler.rng.integers(2**63 - 1))]
+        dist.broadcast_object_list(seed, src=0)
+        sampler.set_seed(seed[0])
+        sampler.shard(dist.get_rank(), dist.get_world_size())
+
+
 def get_sampler(sampler):
+    if dist.is_available() and dist.is_initialized():
+        return DistributedSamplerWrapper(sampler)
     return TorchSamplerWrapper(sampler)
@@ -1,3 +1,4 @@
+import os
 import time
 import math
 import torch
@@ -27,6 +28,9 @@ class KPFCNN(BaseModel):
     Class defining KPFCNN. A model for Semantic Segmentation.
     """
 
+    # Config fields the output of preprocess depends on, used in the cache key.
+    preprocess_cfg_keys = ['first_subsampling_dl']
+
     def __init__(
             self,
             name='KPFCNN',
@@ -263,6 +267,8 @@ class KPFCNN(BaseModel):
         return
 
     def forward(self, batch):
+        # Batches collated in dataloader workers are still on the host.
+        batch.to(next(self.parameters()).device)
 
         # Get input features
         x = batch.features.clone().detach()
@@ -410,8 +416,6 @@ class KPFCNN(BaseModel):
         p_origin[0, 3] = 1
         p0 = p_origin[:, :3]
         p0 = np.squeeze(p0)
-        o_pts = None
-        o_labels = None
 
         num_merged = 0
 
@@ -422,31 +426,30 @@ class KPFCNN(BaseModel):
             'p0_list': [],
             's_list': [],
             'R_list': [],
-            'r_inds_list': [],
             'r_mask_list': [],
-            'val_labels_list': [],
             'cfg': self.cfg
         }
 
         curr_num_points = 0
-        max_num_points = min(self.cfg.batch_limit, self.cfg.max_in_points)
+        # A sample over batch_limit makes a batch on its own.
+        max_num_points = self.cfg.max_in_points
         min_in_points = self.cfg.get('min_in_points', 3)
         min_in_points = min(min_in_points, self.cfg.max_in_points)
 
         while curr_num_points < min_in_points:
 
-            new_points = points.copy()
+            # The sampler only gathers the crop, the cached scene is not copied.
             curr_new_points, mask_inds, p0 = self.trans_point_sampler(
-                pc=new_points,
+                pc=points,
                 feat=feat,
                 label=sem_labels,
                 search_tree=search_tree,
                 num_points=min_in_points,
-                radius=self.cfg.in_radius)
+                radius=self.cfg.in_radius,
+                cloud_id=attr.get('idx', None))
 
             curr_sem_labels = sem_labels[mask_inds]
 
-            o_labels = sem_labels.astype(np.int32)
             # In case of validation, keep the original points in memory
             # if attr['split'] in ['test']:
             #     selected_points = curr_new_points.copy()
@@ -454,15 +457,16 @@ class KPFCNN(BaseModel):
             #     o_labels = sem_labels.astype(np.int32)
 
             curr_new_points = curr_new_points - p0
+            # Normalize the crop only, cached arrays are read-only.
+            curr_feat = feat[mask_inds] if feat is not None else None
             t_normalize = self.cfg.get('t_normalize', {})
             curr_new_points, curr_feat = trans_normalize(
-                curr_new_points, feat, t_normalize)
+                curr_new_points, curr_feat, t_normalize)
 
             if curr_feat is None:
                 curr_new_coords = curr_new_points.copy()
             else:
-                curr_new_coords = np.hstack(
-                    (curr_new_points, curr_feat[mask_inds, :]))
+                curr_new_coords = np.hstack((curr_new_points, curr_feat))
 
             in_pts = curr_new_points
             in_fts = curr_new_coords
@@ -485,10 +489,6 @@ class KPFCNN(BaseModel):
             curr_num_points += n
 
             reproj_mask = mask_inds
-            if attr['split'] in ['test']:
-                proj_inds = data['proj_inds']
-            else:
-                proj_inds = np.zeros((0,))
             # Before augmenting, compute reprojection inds (only for validation and test)
             # if attr['split'] in ['test', 'validation']:
             #     proj_inds = np.zeros((0,))
@@ -518,9 +518,14 @@ class KPFCNN(BaseModel):
             result_data['p0_list'] += [p0]
             result_data['s_list'] += [scale]
             result_data['R_list'] += [R]
-            result_data['r_inds_list'] += [proj_inds]
             result_data['r_mask_list'] += [reproj_mask]
-            result_data['val_labels_list'] += [o_labels]
+
+        # The neighbors and pooling indices of all layers are computed here,
+        # in the dataloader workers, and only concatenated by the batcher.
+        stack_lengths = np.array([p.shape[0] for p in result_data['p_list']],
+                                 dtype=np.int32)
+        result_data['layers'] = self.segmentation_inputs(
+            np.concatenate(result_data['p_list'], axis=0), stack_lengths)
 
         return result_data
 
@@ -561,9 +566,7 @@ class KPFCNN(BaseModel):
         lengths = batch.lengths[0].cpu().numpy()
 
         f_inds = batch.frame_inds.cpu().numpy()
-        r_inds_list = batch.reproj_inds
         r_mask_list = batch.reproj_masks
-        labels_list = batch.val_labels
 
         i0 = 0
         for b_i, length in enumerate(lengths):
@@ -571,7 +574,6 @@ class KPFCNN(BaseModel):
             probs = stk_probs[i0:i0 + length]
             labels = np.argmax(probs, 1)
 
-            proj_inds = r_inds_list[b_i]
             proj_mask = r_mask_list[b_i]
             test_probs[proj_mask] = self.test_smooth * test_probs[proj_mask] + (
                 1 - self.test_smooth) * probs
@@ -591,15 +593,12 @@ class KPFCNN(BaseModel):
         lengths = batch.lengths[0].cpu().numpy()
 
         f_inds = batch.frame_inds.cpu().numpy()
-        r_inds_list = batch.reproj_inds
         r_mask_list = batch.reproj_masks
-        labels_list = batch.val_labels
 
         i0 = 0
         for b_i, length in enumerate(lengths):
             # Get prediction
             probs = stk_probs[i0:i0 + length]
-            proj_inds = r_inds_list[b_i]
             proj_mask = r_mask_list[b_i]
             self.test_probs[proj_mask] = self.test_smooth * self.test_probs[
                 proj_mask] + (1 - self.test_smooth) * probs
@@ -629,7 +628,7 @@ class KPFCNN(BaseModel):
     def big_neighborhood_filter(self, neighbors, layer):
         """
         Filter neighborhoods with max number of neighbors. Limit is set to keep XX% of the neighborhoods untouched.
-        Limit is computed at initialization
+        Limit is computed by calibrate_neighborhood_limits
         """
 
         # crop neighbors matrix
@@ -638,6 +637,191 @@ class KPFCNN(BaseModel):
         else:
             return neighbors
 
+    def calibrate_neighborhood_limits(self, samples, num_neighborhoods=10000):
+        """
+        Set the neighborhood limits from the neighbor counts of samples.
+
+        The neighbor counts of each layer are gathered in a histogram until
+        every layer has num_neighborhoods neighborhoods. The limit of a layer
+        then keeps the share 'neighborhood_limit_ratio' of the model config
+        (0.9 by default) of its neighborhoods untouched.
+
+        Args:
+            samples: iterable of the outputs of transform, computed without
+                neighborhood limits.
+            num_neighborhoods: number of neighborhoods to count per layer.
+
+        Returns:
+            The list of the limits of the layers.
+        """
+        untouched_ratio = self.cfg.get('neighborhood_limit_ratio', 0.9)
+        hist_n = int(np.ceil(4 / 3 * np.pi * (self.cfg.deform_radius + 1)**3))
+
+        self.neighborhood_limits = []
+        neighb_hists = None
+        for data in samples:
+            neighbors = data['layers']['neighbors']
+            if neighb_hists is None:
+                neighb_hists = np.zeros((len(neighbors), hist_n),
+                                        dtype=np.int64)
+
+            for layer, neighb_mat in enumerate(neighbors):
+                counts = np.sum(neighb_mat < neighb_mat.shape[0], axis=1)
+                counts = np.minimum(counts, hist_n - 1)
+                neighb_hists[layer] += np.bincount(counts, minlength=hist_n)
+
+            # Layers without convolution have no neighborhoods to count.
+            totals = np.sum(neighb_hists, axis=1)
+            if np.all((totals == 0) | (totals >= num_neighborhoods)) and \
+                    np.any(totals > 0):
+                break
+
+        if neighb_hists is None:
+            return self.neighborhood_limits
+
+        cumsum = np.cumsum(neighb_hists, axis=1)
+        limits = np.sum(cumsum < untouched_ratio * cumsum[:, -1:], axis=1)
+        limits[cumsum[:, -1] == 0] = hist_n
+        self.neighborhood_limits = [int(limit) for limit in limits]
+        return self.neighborhood_limits
+
+    def segmentation_inputs(self, stacked_points, stack_lengths):
+        """Points, neighbors, pooling and upsampling indices of each layer.
+
+        Args:
+            stacked_points: (N, 3) points of the crops of a sample.
+            stack_lengths: (B) number of points of each crop.
+
+        Returns:
+            A dict with the lists 'points', 'neighbors', 'pools', 'upsamples'
+            and 'lengths' of the layers. Missing neighbors are given the
+            index of the number of support points (shadow neighbor).
+        """
+        # Starting radius of convolutions
+        r_normal = self.cfg.first_subsampling_dl * self.cfg.conv_radius
+
+        # Starting layer
+        layer_blocks = []
+
+        # Lists of inputs
+        input_points = []
+        input_neighbors = []
+        input_pools = []
+        input_upsamples = []
+        input_stack_lengths = []
+
+        ######################
+        # Loop over the blocks
+        ######################
+
+        arch = self.cfg.architecture
+
+        for block_i, block in enumerate(arch):
+
+            # Get all blocks of the layer
+            if not ('pool' in block or 'strided' in block or
+                    'global' in block or 'upsample' in block):
+                layer_blocks += [block]
+                continue
+
+            # Convolution neighbors indices
+            # *****************************
+
+            if layer_blocks:
+                # Convolutions are done in this layer, compute the neighbors with the good radius
+                if np.any(['deformable' in blck for blck in layer_blocks]):
+                    r = r_normal * self.cfg.deform_radius / self.cfg.conv_radius
+                else:
+                    r = r_normal
+                conv_i = batch_neighbors(stacked_points, stacked_points,
+                                         stack_lengths, stack_lengths, r)
+
+            else:
+                # This layer only perform pooling, no neighbors required
+                conv_i = np.zeros((0, 1), dtype=np.int32)
+
+            # Pooling neighbors indices
+            # *************************
+
+            # If end of layer is a pooling operation
+            if 'pool' in block or 'strided' in block:
+
+                # New subsampling length
+                dl = 2 * r_normal / self.cfg.conv_radius
+
+                # Subsampled points
+                pool_p, pool_b = batch_grid_subsampling(stacked_points,
+                                                        stack_lengths,
+                                                        sampleDl=dl)
+
+                # Radius of pooled neighbors
+                if 'deformable' in block:
+                    r = r_normal * self.cfg.deform_radius / self.cfg.conv_radius
+                else:
+                    r = r_normal
+
+                # Subsample indices
+                pool_i = batch_neighbors(pool_p, stacked_points, pool_b,
+                                         stack_lengths, r)
+
+                # Upsample indices (with the radius of the next layer to keep wanted density)
+                up_i = batch_neighbors(stacked_points, pool_p, stack_lengths,
+                                       pool_b, 2 * r)
+
+            else:
+                # No pooling in the end of this layer, no pooling indices required
+                pool_i = np.zeros((0, 1), dtype=np.int32)
+                pool_p = np.zeros((0, 3), dtype=np.float32)
+                pool_b = np.zeros((0,), dtype=np.int32)
+                up_i = np.zeros((0, 1), dtype=np.int32)
+
+            # Reduce size of neighbors matrices by eliminating furthest point
+            conv_i = self.big_neighborhood_filter(conv_i, len(input_points))
+            pool_i = self.big_neighborhood_filter(pool_i, len(input_points))
+            if up_i.shape[0] > 0:
+                up_i = self.big_neighborhood_filter(up_i, len(input_points) + 1)
+
+            # Updating input lists
+            input_points += [stacked_points]
+            input_neighbors += [conv_i.astype(np.int64)]
+            input_pools += [pool_i.astype(np.int64)]
+            input_upsamples += [up_i.astype(np.int64)]
+            input_stack_lengths += [stack_lengths]
+
+            # New points for next layer
+            stacked_points = pool_p
+            stack_lengths = pool_b
+
+            # Update radius and reset blocks
+            r_normal *= 2
+            layer_blocks = []
+
+            # Stop when meeting a global pooling or upsampling
+            if 'global' in block or 'upsample' in block:
+                break
+
+        return {
+            'points': input_points,
+            'neighbors': input_neighbors,
+            'pools': input_pools,
+            'upsamples': input_upsamples,
+            'lengths': input_stack_lengths
+        }
+
+    def calibrate_batch_limit(self, num_points, batch_size):
+        """
+        Set batch_limit so that batches hold batch_size samples on average.
+
+        Args:
+            num_points: number of points of sampled outputs of transform.
+            batch_size: number of samples of a batch to aim for.
+
+        Returns:
+            The batch limit.
+        """
+        self.cfg.batch_limit = int(np.ceil(batch_size * np.mean(num_points)))
+        return self.cfg.batch_limit
+
     def augmentation_transform(self,
                                points,
                                normals=None,
@@ -798,6 +982,25 @@ def gather(x, idx, method=2):
         raise ValueError('Unkown method')
 
 
+def available_memory(device):
+    """
+    Available memory in bytes on a device.
+    :param device: torch device
+    :return: free memory of a cuda device, or available memory of the host
+    """
+    if device.type == 'cuda':
+        return torch.cuda.mem_get_info(device)[0]
+
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
 def radius_gaussian(sq_r, sig, eps=1e-9):
     """
     Compute a radius gaussian (gaussian of distance)
@@ -885,7 +1088,8 @@ class KPConv(nn.Module):
                  KP_influence='linear',
                  aggregation_mode='sum',
                  deformable=False,
-                 modulated=False):
+                 modulated=False,
+                 block_size=None):
         """
         Initialize parameters for KPConvDeformable.
         :param kernel_size: Number of kernel points.
@@ -899,6 +1103,8 @@ class KPConv(nn.Module):
         :param aggregation_mode: choose to sum influences, or only keep the closest ('closest', 'sum').
         :param deformable: choose deformable or not
         :param modulated: choose if kernel weights are modulated in addition to deformed
+        :param block_size: number of query points convolved at once, to bound the memory of the difference and weight
+                           tensors. None convolves all points at once, 'auto' picks it from the available memory.
         """
         super(KPConv, self).__init__()
 
@@ -914,6 +1120,7 @@ class KPConv(nn.Module):
         self.aggregation_mode = aggregation_mode
         self.deformable = deformable
         self.modulated = modulated
+        self.block_size = block_size
 
         # Running variable containing deformed KP distance to input points. (used in regularization loss)
         self.min_d2 = None
@@ -939,7 +1146,8 @@ class KPConv(nn.Module):
                                       radius,
                                       fixed_kernel_points=fixed_kernel_points,
                                       KP_influence=KP_influence,
-                                      aggregation_mode=aggregation_mode)
+                                      aggregation_mode=aggregation_mode,
+                                      block_size=block_size)
             self.offset_bias = Parameter(torch.zeros(self.offset_dim,
                                                      dtype=torch.float32),
                                          requires_grad=True)
@@ -1028,6 +1236,74 @@ class KPConv(nn.Module):
         # Add a fake point in the last row for shadow neighbors
         s_pts = torch.cat((s_pts, torch.zeros_like(s_pts[:1, :]) + 1e6), 0)
 
+        # Add a zero feature for shadow neighbors
+        x = torch.cat((x, torch.zeros_like(x[:1, :])), 0)
+
+        # Apply offsets to kernel points [n_points, n_kpoints, dim]
+        if self.deformable:
+            self.deformed_KP = offsets + self.kernel_points
+
+        # The query points are convolved independently, so they may be split
+        # into blocks which only need the tensors of their neighborhoods.
+        n_points = q_pts.shape[0]
+        block_size = self.get_block_size(neighb_inds, x)
+        if block_size >= n_points:
+            return self.convolve(q_pts, s_pts, neighb_inds, x, self.deformed_KP,
+                                 modulations)
+
+        outputs = []
+        min_d2 = []
+        for i0 in range(0, n_points, block_size):
+            block = slice(i0, i0 + block_size)
+            outputs.append(
+                self.convolve(
+                    q_pts[block], s_pts, neighb_inds[block], x,
+                    self.deformed_KP[block] if self.deformable else None,
+                    modulations[block] if modulations is not None else None))
+            min_d2.append(self.min_d2)
+
+        if self.deformable:
+            self.min_d2 = torch.cat(min_d2, 0)
+        return torch.cat(outputs, 0)
+
+    def get_block_size(self, neighb_inds, x):
+        """
+        Number of query points to convolve at once.
+        :param neighb_inds: [n_points, n_neighbors] neighbor indices
+        :param x: [n_supports, in_fdim] support features
+        :return: the block size
+        """
+        n_points = neighb_inds.shape[0]
+        if self.block_size is None:
+            return n_points
+        elif self.block_size != 'auto':
+            return max(int(self.block_size), 1)
+
+        # Floats of the largest tensors per query point: the differences, the
+        # distances and weights, the neighbor and weighted features and the
+        # kernel outputs.
+        n_neighbors = neighb_inds.shape[1]
+        num_floats = self.K * n_neighbors * (self.p_dim + 2) + \
+            n_neighbors * x.shape[1] + \
+            self.K * (x.shape[1] + self.out_channels)
+        num_bytes = num_floats * x.element_size()
+
+        # A quarter of the available memory is used, the rest is left to the
+        # other tensors and processes.
+        return max(int(available_memory(x.device) // 4 // num_bytes), 1)
+
+    def convolve(self, q_pts, s_pts, neighb_inds, x, deformed_KP, modulations):
+        """
+        Convolution of a block of query points.
+        :param q_pts: [n_points, dim] query points
+        :param s_pts: [n_supports + 1, dim] support points with the shadow point last
+        :param neighb_inds: [n_points, n_neighbors] neighbor indices
+        :param x: [n_supports + 1, in_fdim] support features with the shadow feature last
+        :param deformed_KP: [n_points, n_kpoints, dim] deformed kernel points, or None
+        :param modulations: [n_points, n_kpoints] kernel modulations, or None
+        :return: [n_points, out_fdim] output features
+        """
+
         # Get neighbor points [n_points, n_neighbors, dim]
         neighbors = s_pts[neighb_inds, :]
 
@@ -1036,8 +1312,7 @@ class KPConv(nn.Module):
 
         # Apply offsets to kernel points [n_points, n_kpoints, dim]
         if self.deformable:
-            self.deformed_KP = offsets + self.kernel_points
-            deformed_K_points = self.deformed_KP.unsqueeze(1)
+            deformed_K_points = deformed_KP.unsqueeze(1)
         else:
             deformed_K_points = self.kernel_points
 
@@ -1117,9 +1392,6 @@ class KPConv(nn.Module):
             raise ValueError(
                 "Unknown convolution mode. Should be 'closest' or 'sum'")
 
-        # Add a zero feature for shadow neighbors
-        x = torch.cat((x, torch.zeros_like(x[:1, :])), 0)
-
         # Get the features of each neighborhood [n_points, n_neighbors, in_fdim]
         neighb_x = gather(x, new_neighb_inds)
 
@@ -1305,7 +1577,8 @@ class SimpleBlock(nn.Module):
                              KP_influence=config.KP_influence,
                              aggregation_mode=config.aggregation_mode,
                              deformable='deform' in block_name,
-                             modulated=config.modulated)
+                             modulated=config.modulated,
+                             block_size=config.get('kpconv_block_size', None))
 
         # Other opperations
         self.batch_norm = BatchNormBlock(out_dim // 2, self.use_bn,
@@ -1375,7 +1648,8 @@ class ResnetBottleneckBlock(nn.Module):
                              KP_influence=config.KP_influence,
                              aggregation_mode=config.aggregation_mode,
                              deformable='deform' in block_name,
-                             modulated=config.modulated)
+                             modulated=config.modulated,
+                             block_size=config.get('kpconv_block_size', None))
         self.batch_norm_conv = BatchNormBlock(out_dim // 4, self.use_bn,
                                               self.bn_momentum)
 
@@ -2041,85 +2315,47 @@ def batch_grid_subsampling(points,
         # Apply rotations
         #################
 
-        i0 = 0
-        points = points.copy()
-        for bi, length in enumerate(batches_len):
-            # Apply the rotation
-            points[i0:i0 + length, :] = np.sum(
-                np.expand_dims(points[i0:i0 + length, :], 2) * R[bi], axis=1)
-            i0 += length
+        points = batch_rotate(points, batches_len, R)
 
     #######################
     # Sunsample and realign
     #######################
 
-    if (features is None) and (labels is None):
-        s_points, s_len = subsample_batch(points,
-                                          batches_len,
-                                          sampleDl=sampleDl,
-                                          max_p=max_p,
-                                          verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                s_points[i0:i0 + length, :] = np.sum(
-                    np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T,
-                    axis=1)
-                i0 += length
-        return s_points, s_len
-
-    elif (labels is None):
-        s_points, s_len, s_features = subsample_batch(points,
-                                                      batches_len,
-                                                      features=features,
-                                                      sampleDl=sampleDl,
-                                                      max_p=max_p,
-                                                      verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                # Apply the rotation
-                s_points[i0:i0 + length, :] = np.sum(
-                    np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T,
-                    axis=1)
-                i0 += length
-        return s_points, s_len, s_features
-
-    elif (features is None):
-        s_points, s_len, s_labels = subsample_batch(points,
-                                                    batches_len,
-                                                    classes=labels,
-                                                    sampleDl=sampleDl,
-                                                    max_p=max_p,
-                                                    verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                # Apply the rotation
-                s_points[i0:i0 + length, :] = np.sum(
-                    np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T,
-                    axis=1)
-                i0 += length
-        return s_points, s_len, s_labels
+    kwargs = {}
+    if features is not None:
+        kwargs['features'] = features
+    if labels is not None:
+        kwargs['classes'] = labels
+    # Subsampled points and lengths, followed by the features and labels if
+    # given.
+    outputs = list(
+        subsample_batch(points,
+                        batches_len,
+                        sampleDl=sampleDl,
+                        max_p=max_p,
+                        verbose=verbose,
+                        **kwargs))
+    if random_grid_orient:
+        outputs[0] = batch_rotate(outputs[0], outputs[1],
+                                  np.transpose(R, (0, 2, 1)))
+    return tuple(outputs)
 
-    else:
-        s_points, s_len, s_features, s_labels = subsample_batch(
-            points,
-            batches_len,
-            features=features,
-            classes=labels,
-            sampleDl=sampleDl,
-            max_p=max_p,
-            verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                # Apply the rotation
-                s_points[i0:i0 + length, :] = np.sum(
-                    np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T,
-                    axis=1)
-                i0 += length
-        return s_points, s_len, s_features, s_labels
+
+def batch_rotate(points, batches_len, R):
+    """
+    Rotate each batch element by its own rotation matrix.
+    :param points: (N, 3) matrix of the stacked points
+    :param batches_len: (B) the list of lengths of batch elements in points
+    :param R: (B, 3, 3) rotation matrices, applied as points @ R[b]
+    :return: (N, 3) matrix of the rotated points
+    """
+    rotated = np.empty(points.shape, dtype=np.result_type(points, R))
+    i0 = 0
+    for bi, length in enumerate(batches_len):
+        # A matmul per element, without an (N, 3, 3) temporary.
+        np.matmul(points[i0:i0 + length], R[bi], out=rotated[i0:i0 + length])
+        i0 += length
+    return rotated
 
 
 def p2p_fitting_regularizer(net):
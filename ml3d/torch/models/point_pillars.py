@@ -61,6 +61,9 @@ class PointPillars(BaseModel):
         head: Config of anchor head module.
     """
 
+    # Config fields the output of preprocess depends on, used in the cache key.
+    preprocess_cfg_keys = ['point_cloud_range']
+
     def __init__(self,
                  name="PointPillars",
                  device="cuda",
@@ -130,7 +133,13 @@ class PointPillars(BaseModel):
         return voxels, num_points, coors_batch
 
     def forward(self, inputs):
-        x = self.extract_feats(inputs)
+        """Forward pass on a batch from the ConcatBatcher.
+
+        Args:
+            inputs: An ObjectDetectBatch, with a list of point tensors of
+                shape (N, C) in `inputs.point`.
+        """
+        x = self.extract_feats(inputs.point)
         outs = self.bbox_head(x)
         return outs
 
@@ -140,8 +149,8 @@ class PointPillars(BaseModel):
 
     def loss(self, results, inputs):
         scores, bboxes, dirs = results
-        gt_labels = inputs['labels']
-        gt_bboxes = inputs['bboxes']
+        gt_labels = torch.cat(inputs.labels, axis=0)
+        gt_bboxes = inputs.bboxes
 
         # generate and filter bboxes
         target_bboxes, target_idx, pos_idx, neg_idx = self.bbox_head.assign_bboxes(
@@ -177,7 +186,7 @@ class PointPillars(BaseModel):
         if len(pos_idx) > 0:
             # direction classification loss
             # to discrete bins
-            target_dirs = gt_bboxes[target_idx][:, -1]
+            target_dirs = torch.cat(gt_bboxes, axis=0)[target_idx][:, -1]
             target_dirs = limit_period(target_dirs, 0, 2 * np.pi)
             target_dirs = (target_dirs / np.pi).long() % 2
 
@@ -283,22 +292,18 @@ class PointPillars(BaseModel):
         if attr['split'] not in ['test', 'testing', 'val', 'validation']:
             data = self.augment_data(data, attr)
 
-        points = torch.tensor([data['point']],
-                              dtype=torch.float32,
-                              device=self.device)
-
-        labels = torch.tensor([
+        # Host arrays only, the ConcatBatcher converts them to tensors and
+        # the pipeline moves the batch to the device.
+        labels = np.array([
             self.name2lbl.get(bb.label_class, len(self.classes))
             for bb in data['bbox_objs']
         ],
-                              dtype=torch.int64,
-                              device=self.device)
-        bboxes = torch.tensor([bb.to_xyzwhlr() for bb in data['bbox_objs']],
-                              dtype=torch.float32,
-                              device=self.device)
+                          dtype=np.int64)
+        bboxes = np.array([bb.to_xyzwhlr() for bb in data['bbox_objs']],
+                          dtype=np.float32).reshape(-1, 7)
 
         return {
-            'point': points,
+            'point': data['point'],
             'labels': labels,
             'bboxes': bboxes,
             'bbox_objs': data['bbox_objs'],
@@ -309,14 +314,13 @@ class PointPillars(BaseModel):
         bboxes_b, scores_b, labels_b = self.bbox_head.get_bboxes(*results)
 
         inference_result = []
+        for _calib, _bboxes, _scores, _labels in zip(inputs.calib, bboxes_b,
+                                                     scores_b, labels_b):
+            world_cam, cam_img = None, None
+            if _calib is not None:
+                world_cam = _calib.get('world_cam', None)
+                cam_img = _calib.get('cam_img', None)
 
-        world_cam, cam_img = None, None
-        if 'calib' in inputs and inputs['calib'] is not None:
-            calib = inputs['calib']
-            world_cam = calib.get('world_cam', None)
-            cam_img = calib.get('cam_img', None)
-
-        for _bboxes, _scores, _labels in zip(bboxes_b, scores_b, labels_b):
             bboxes = _bboxes.cpu().numpy()
             scores = _scores.cpu().numpy()
             labels = _labels.cpu().numpy()
@@ -870,13 +874,15 @@ class Anchor3DHead(nn.Module):
         """Assigns target bboxes to given anchors.
 
         Args:
-            pred_bboxes (torch.Tensor): Bbox predictions (anchors).
-            target_bboxes (torch.Tensor): Bbox targets.
+            pred_bboxes (torch.Tensor): Bbox predictions (anchors) of a batch.
+            target_bboxes (list[torch.Tensor]): Bbox targets of each sample.
 
         Returns:
             torch.Tensor: Assigned target bboxes for each given anchor.
-            torch.Tensor: Flat index of matched targets.
-            torch.Tensor: Index of positive matches.
+            torch.Tensor: Flat index of matched targets, in the concatenated
+                targets of the batch.
+            torch.Tensor: Index of positive matches, in the flattened
+                anchors of the batch.
             torch.Tensor: Index of negative matches.
         """
 
@@ -884,6 +890,35 @@ class Anchor3DHead(nn.Module):
         anchors = self.anchor_generator.grid_anchors(pred_bboxes.shape[-2:],
                                                      device=pred_bboxes.device)
 
+        num_anchors = anchors.numel() // self.box_code_size
+        assigned_bboxes, target_idxs, pos_idxs, neg_idxs = [], [], [], []
+
+        num_targets = 0
+        for i, targets in enumerate(target_bboxes):
+            res = self.assign_bboxes_single(anchors, targets)
+            assigned_bboxes.append(res[0])
+            target_idxs.append(res[1] + num_targets)
+            pos_idxs.append(res[2] + i * num_anchors)
+            neg_idxs.append(res[3] + i * num_anchors)
+            num_targets += len(targets)
+
+        return (torch.cat(assigned_bboxes,
+                          axis=0), torch.cat(target_idxs, axis=0),
+                torch.cat(pos_idxs, axis=0), torch.cat(neg_idxs, axis=0))
+
+    def assign_bboxes_single(self, anchors, target_bboxes):
+        """Assigns target bboxes of a single sample to the anchors.
+
+        Args:
+            anchors (torch.Tensor): Anchors of the feature map.
+            target_bboxes (torch.Tensor): Bbox targets.
+
+        Returns:
+            torch.Tensor: Assigned target bboxes for each given anchor.
+            torch.Tensor: Flat index of matched targets.
+            torch.Tensor: Index of positive matches.
+            torch.Tensor: Index of negative matches.
+        """
         rot_angles = anchors[0].shape[-2]
 
         # init the tensors for the final result
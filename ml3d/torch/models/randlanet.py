@@ -25,6 +25,9 @@ class RandLANet(BaseModel):
     Class defining RandLANet. A model for Semantic Segmentation.
     """
 
+    # Config fields the output of preprocess depends on, used in the cache key.
+    preprocess_cfg_keys = ['grid_size', 't_align']
+
     def __init__(
             self,
             name='RandLANet',
@@ -149,19 +152,62 @@ class RandLANet(BaseModel):
 
     def transform(self, data, attr, min_possibility_idx=None):
         cfg = self.cfg
-        inputs = dict()
 
-        pc = data['point'].copy()
-        label = data['label'].copy()
-        feat = data['feat'].copy() if data['feat'] is not None else None
+        # The sampler and transform_crop only gather the selected points, so
+        # the (read-only) arrays of the whole scene are not copied.
+        pc = data['point']
+        label = data['label']
+        feat = data['feat']
         tree = data['search_tree']
 
+        # During training several crops can be taken from the same cloud at
+        # once, in which case a list with the inputs of each crop is returned.
+        num_crops = cfg.get('crops_per_cloud', 1)
+        if attr['split'] not in ['training', 'train'] or num_crops < 2:
+            num_crops = None
+
         pc, selected_idxs, center_point = self.trans_point_sampler(
             pc=pc,
             feat=feat,
             label=label,
             search_tree=tree,
-            num_points=self.cfg.num_points)
+            num_points=self.cfg.num_points,
+            cloud_id=attr.get('idx', None),
+            num_crops=num_crops)
+
+        if num_crops is None:
+            pc, selected_idxs = [pc], [selected_idxs]
+
+        crops = [
+            self.transform_crop(pc[i], feat, label, selected_idxs[i], attr)
+            for i in range(len(pc))
+        ]
+
+        # The neighbors of all crops and layers are searched at once. Deeper
+        # layers reuse the knn_candidates neighbors found in the layer above.
+        points = np.stack([crop_pc for crop_pc, _ in crops])
+        input_points, input_neighbors, input_pools, input_up_samples = \
+            DataProcessing.knn_hierarchy(
+                points, cfg.k_n, cfg.sub_sampling_ratio[:cfg.num_layers],
+                num_candidates=cfg.get('knn_candidates', None))
+
+        for i, (_, inputs) in enumerate(crops):
+            inputs['xyz'] = [x[i] for x in input_points]
+            inputs['neigh_idx'] = [x[i] for x in input_neighbors]
+            inputs['sub_idx'] = [x[i] for x in input_pools]
+            inputs['interp_idx'] = [x[i] for x in input_up_samples]
+
+        if num_crops is None:
+            return crops[0][1]
+        return [inputs for _, inputs in crops]
+
+    def transform_crop(self, pc, feat, label, selected_idxs, attr):
+        """Normalizes and augments a single crop of a point cloud.
+
+        Returns the points of the crop and its inputs without the neighbors.
+        """
+        cfg = self.cfg
+        inputs = dict()
 
         label = label[selected_idxs]
         if (feat is None):
@@ -184,33 +230,11 @@ class RandLANet(BaseModel):
         assert cfg.dim_input == feat.shape[
             1], "Wrong feature dimension, please update dim_input(3 + feature_dimension) in config"
 
-        features = feat
-        input_points = []
-        input_neighbors = []
-        input_pools = []
-        input_up_samples = []
-
-        for i in range(cfg.num_layers):
-            neighbour_idx = DataProcessing.knn_search(pc, pc, cfg.k_n)
-
-            sub_points = pc[:pc.shape[0] // cfg.sub_sampling_ratio[i], :]
-            pool_i = neighbour_idx[:pc.shape[0] // cfg.sub_sampling_ratio[i], :]
-            up_i = DataProcessing.knn_search(sub_points, pc, 1)
-            input_points.append(pc)
-            input_neighbors.append(neighbour_idx.astype(np.int64))
-            input_pools.append(pool_i.astype(np.int64))
-            input_up_samples.append(up_i.astype(np.int64))
-            pc = sub_points
-
-        inputs['xyz'] = input_points
-        inputs['neigh_idx'] = input_neighbors
-        inputs['sub_idx'] = input_pools
-        inputs['interp_idx'] = input_up_samples
-        inputs['features'] = features
+        inputs['features'] = feat
         inputs['point_inds'] = selected_idxs
 
         inputs['labels'] = label.astype(np.int64)
-        return inputs
+        return pc, inputs
 
     def inference_begin(self, data):
         self.test_smooth = 0.95
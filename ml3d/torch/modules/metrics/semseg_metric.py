@@ -12,10 +12,18 @@ class SemSegMetric(object):
         self.model = model
         self.dataset = dataset
         self.device = device
+        self.reset()
 
-    def confusion_matrix(self, scores, labels):
+    def reset(self):
+        """Reset the confusion matrix accumulated by update()"""
+        num_classes = self.model.cfg.num_classes
+        self.conf_m = torch.zeros((num_classes, num_classes),
+                                  dtype=torch.int64,
+                                  device=self.device)
+
+    def update(self, scores, labels):
         r"""
-            Compute the confusion matrix of one batch
+            Add the confusion matrix of one batch to the accumulated one
 
             Parameters
             ----------
@@ -28,21 +36,17 @@ class SemSegMetric(object):
             -------
             confusion matrix of this batch
         """
-        num_classes = scores.size(-2)
-        predictions = torch.max(scores, dim=-2).indices.cpu().data.numpy()
-        labels = labels.cpu().data.numpy()
-
-        conf_m = np.zeros((num_classes, num_classes), dtype=np.int32)
-
-        for label in range(num_classes):
-            for pred in range(num_classes):
-                conf_m[label][pred] = np.sum(
-                    np.logical_and(labels == label, predictions == pred))
+        conf_m = self.confusion_matrix(scores, labels)
+        self.conf_m += conf_m.to(self.conf_m.device)
         return conf_m
 
-    def acc(self, scores, labels):
+    def all_reduce(self):
+        """Sum the accumulated confusion matrices of all ranks"""
+        torch.distributed.all_reduce(self.conf_m)
+
+    def confusion_matrix(self, scores, labels):
         r"""
-            Compute the per-class accuracies and the overall accuracy 
+            Compute the confusion matrix of one batch on the device
 
             Parameters
             ----------
@@ -53,38 +57,50 @@ class SemSegMetric(object):
 
             Returns
             -------
-            list of floats of length num_classes+1 
-            (last item is overall accuracy)
+            confusion matrix of this batch, torch.LongTensor of shape (C, C)
+            on the device of the scores, rows are labels and columns are
+            predictions
         """
         num_classes = scores.size(-2)
         predictions = torch.max(scores, dim=-2).indices
+        labels = labels.to(predictions.device)
+
+        # Scatter into a fixed size, unlike bincount this does not need the
+        # maximum index on the host and does not synchronize with the device.
+        inds = labels.reshape(-1) * num_classes + predictions.reshape(-1)
+        conf_m = torch.zeros(num_classes**2,
+                             dtype=torch.int64,
+                             device=inds.device)
+        conf_m.scatter_add_(0, inds, torch.ones_like(inds))
+        return conf_m.reshape(num_classes, num_classes)
+
+    def acc(self, scores=None, labels=None):
+        r"""
+            Compute the per-class accuracies and the overall accuracy 
 
-        accuracies = []
-        accuracy_mask = predictions == labels
-
-        n_total = 0
-        n_correct = 0
-
-        for label in range(num_classes):
-            label_mask = labels == label
-            per_class_accuracy = (accuracy_mask & label_mask).float().sum()
-            n_correct += per_class_accuracy
-            per_class_accuracy /= label_mask.float().sum()
-            n_total += label_mask.float().sum()
-            accuracies.append(per_class_accuracy.cpu().item())
+            Parameters
+            ----------
+            scores: torch.FloatTensor, shape (B?, C, N)
+                raw scores for each class, None for the accumulated matrix
+            labels: torch.LongTensor, shape (B?, N)
+                ground truth labels
 
-        # overall accuracy
-        accuracies.append(np.nanmean(accuracies))
-        return accuracies
+            Returns
+            -------
+            list of floats of length num_classes+1 
+            (last item is overall accuracy)
+        """
+        conf_m = self._get_confusion_matrix(scores, labels)
+        return self.acc_from_confusion_matrix(conf_m)
 
-    def iou(self, scores, labels):
+    def iou(self, scores=None, labels=None):
         r"""
             Compute the per-class IoU and the mean IoU 
 
             Parameters
             ----------
             scores: torch.FloatTensor, shape (B?, C, N)
-                raw scores for each class
+                raw scores for each class, None for the accumulated matrix
             labels: torch.LongTensor, shape (B?, N)
                 ground truth labels
 
@@ -92,23 +108,36 @@ class SemSegMetric(object):
             -------
             list of floats of length num_classes+1 (last item is mIoU)
         """
-        num_classes = scores.size(-2)
-        predictions = torch.max(scores, dim=-2).indices
-
-        ious = []
-
-        n_total = 0
-        n_correct = 0
+        conf_m = self._get_confusion_matrix(scores, labels)
+        return self.iou_from_confusion_matrix(conf_m)
+
+    def _get_confusion_matrix(self, scores, labels):
+        if scores is None:
+            conf_m = self.conf_m
+        else:
+            conf_m = self.confusion_matrix(scores, labels)
+        return conf_m.cpu().numpy()
+
+    @staticmethod
+    def acc_from_confusion_matrix(conf_m):
+        """Per-class accuracies and their mean from a confusion matrix"""
+        conf_m = np.asarray(conf_m, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            accuracies = np.diag(conf_m) / conf_m.sum(1)
+
+        accuracies = list(accuracies)
+        accuracies.append(np.nanmean(accuracies))
+        return accuracies
 
-        for label in range(num_classes):
-            pred_mask = predictions == label
-            labels_mask = labels == label
-            iou = (pred_mask & labels_mask).float().sum()
-            n_correct += iou
-            iou = iou / (pred_mask | labels_mask).float().sum()
-            n_total += (pred_mask | labels_mask).float().sum()
-            ious.append(iou.cpu().item())
+    @staticmethod
+    def iou_from_confusion_matrix(conf_m):
+        """Per-class IoU and the mean IoU from a confusion matrix"""
+        conf_m = np.asarray(conf_m, dtype=np.float64)
+        tp = np.diag(conf_m)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ious = tp / (conf_m.sum(0) + conf_m.sum(1) - tp)
 
+        ious = list(ious)
         ious.append(np.nanmean(ious))
         return ious
 
@@ -140,44 +169,19 @@ class SemSegMetric(object):
 
         return valid_pred, valid_gt
 
-    def iou_np_label(self, pred, gt):
+    def confusion_matrix_np_label(self, pred, gt):
+        """Confusion matrix of valid predicted and ground truth labels"""
         valid_pred, valid_gt = self.filter_valid_label_np(pred, gt)
         num_classes = self.dataset.num_classes
 
-        ious = []
-
-        n_total = 0
-        n_correct = 0
-
-        for label in range(num_classes):
-            pred_mask = valid_pred == label
-            labels_mask = valid_gt == label
-            iou = (pred_mask & labels_mask).sum()
-            n_correct += iou
-            iou = iou / (pred_mask | labels_mask).sum()
-            n_total += (pred_mask | labels_mask).sum()
-            ious.append(iou)
+        conf_m = np.bincount(valid_gt * num_classes + valid_pred,
+                             minlength=num_classes**2)
+        return conf_m.reshape(num_classes, num_classes)
 
-        ious.append(np.nanmean(ious))
-        return ious
+    def iou_np_label(self, pred, gt):
+        conf_m = self.confusion_matrix_np_label(pred, gt)
+        return self.iou_from_confusion_matrix(conf_m)
 
     def acc_np_label(self, pred, gt):
-        valid_pred, valid_gt = self.filter_valid_label_np(pred, gt)
-        num_classes = self.dataset.num_classes
-
-        accuracies = []
-        accuracy_mask = valid_pred == valid_gt
-
-        n_total = 0
-        n_correct = 0
-
-        for label in range(num_classes):
-            label_mask = valid_gt == label
-            per_class_accuracy = (accuracy_mask & label_mask).sum()
-            n_correct += per_class_accuracy
-            per_class_accuracy /= label_mask.sum()
-            n_total += label_mask.sum()
-            accuracies.append(per_class_accuracy)
-
-        accuracies.append(np.nanmean(accuracies))
-        return accuracies
+        conf_m = self.confusion_matrix_np_label(pred, gt)
+        return self.acc_from_confusion_matrix(conf_m)
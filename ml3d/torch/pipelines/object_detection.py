@@ -11,7 +11,7 @@ from torch.utils.data import DataLoader
 from pathlib import Path
 
 from .base_pipeline import BasePipeline
-from ..dataloaders import TorchDataloader
+from ..dataloaders import TorchDataloader, ConcatBatcher, worker_init_fn
 from torch.utils.tensorboard import SummaryWriter
 from ..utils import latest_torch_ckpt
 from ...utils import make_dir, PIPELINE, LogRecord, get_runid, code2md
@@ -30,6 +30,16 @@ log = logging.getLogger(__name__)
 class ObjectDetection(BasePipeline):
     """
     Pipeline for object detection. 
+
+    Args:
+        batch_size: The batch size to be used for training.
+        val_batch_size: The batch size to be used for validation.
+        num_workers: The number of dataloader worker processes, 0 loads the
+            data in the main process.
+        pin_memory: Indicates if batches are loaded into pinned memory for
+            faster transfer to the GPU.
+        seed: Seed of the shuffling and of the dataloader workers, None for
+            fresh entropy.
     """
 
     def __init__(self,
@@ -39,6 +49,11 @@ class ObjectDetection(BasePipeline):
                  main_log_dir='./logs/',
                  device='cuda',
                  split='train',
+                 batch_size=1,
+                 val_batch_size=1,
+                 num_workers=0,
+                 pin_memory=False,
+                 seed=None,
                  **kwargs):
         super().__init__(model=model,
                          dataset=dataset,
@@ -46,7 +61,13 @@ class ObjectDetection(BasePipeline):
                          main_log_dir=main_log_dir,
                          device=device,
                          split=split,
+                         batch_size=batch_size,
+                         val_batch_size=val_batch_size,
+                         num_workers=num_workers,
+                         pin_memory=pin_memory,
+                         seed=seed,
                          **kwargs)
+        self.rng = np.random.default_rng(seed)
 
     def run_inference(self, data):
         """
@@ -61,13 +82,12 @@ class ObjectDetection(BasePipeline):
 
         model.eval()
 
+        batcher = ConcatBatcher(self.device, model.cfg.name)
         with torch.no_grad():
-            inputs = torch.tensor(data['point'],
-                                  dtype=torch.float32,
-                                  device=self.device)
-            inputs = torch.reshape(inputs, (1, -1, inputs.shape[-1]))
+            inputs = batcher.collate_fn([{'data': data, 'attr': {}}])
+            inputs.to(self.device)
             results = model(inputs)
-            boxes = model.inference_end(results, data)
+            boxes = model.inference_end(results, inputs)
 
         return boxes
 
@@ -129,14 +149,19 @@ class ObjectDetection(BasePipeline):
         log.info("Logging in file : {}".format(log_file_path))
         log.addHandler(logging.FileHandler(log_file_path))
 
+        batcher = ConcatBatcher(device, model.cfg.name)
         valid_dataset = dataset.get_split('validation')
-        valid_loader = TorchDataloader(dataset=valid_dataset,
-                                       preprocess=model.preprocess,
-                                       transform=model.transform,
-                                       use_cache=dataset.cfg.use_cache,
-                                       shuffle=True,
-                                       steps_per_epoch=dataset.cfg.get(
-                                           'steps_per_epoch_valid', None))
+        valid_split = TorchDataloader(dataset=valid_dataset,
+                                      preprocess=model.preprocess,
+                                      transform=model.transform,
+                                      use_cache=dataset.cfg.use_cache,
+                                      steps_per_epoch=dataset.cfg.get(
+                                          'steps_per_epoch_valid', None))
+        valid_loader = DataLoader(valid_split,
+                                  batch_size=cfg.val_batch_size,
+                                  shuffle=True,
+                                  collate_fn=batcher.collate_fn,
+                                  **self.get_loader_cfg())
 
         log.info("Started validation")
 
@@ -145,9 +170,9 @@ class ObjectDetection(BasePipeline):
         pred = []
         gt = []
         with torch.no_grad():
-            for i in tqdm(range(len(valid_loader)), desc='validation'):
-                data = valid_loader[i]['data']
-                results = model(data['point'])
+            for data in tqdm(valid_loader, desc='validation'):
+                data.to(device)
+                results = model(data)
                 loss = model.loss(results, data)
                 for l, v in loss.items():
                     if not l in self.valid_losses:
@@ -156,8 +181,8 @@ class ObjectDetection(BasePipeline):
 
                 # convert to bboxes for mAP evaluation
                 boxes = model.inference_end(results, data)
-                pred.append(BEVBox3D.to_dicts(boxes[0]))
-                gt.append(BEVBox3D.to_dicts(data['bbox_objs']))
+                pred.extend([BEVBox3D.to_dicts(b) for b in boxes])
+                gt.extend([BEVBox3D.to_dicts(b) for b in data.bbox_objs])
 
         sum_loss = 0
         desc = "validation - "
@@ -223,13 +248,19 @@ class ObjectDetection(BasePipeline):
         log.info("Logging in file : {}".format(log_file_path))
         log.addHandler(logging.FileHandler(log_file_path))
 
+        batcher = ConcatBatcher(device, model.cfg.name)
         train_dataset = dataset.get_split('training')
-        train_loader = TorchDataloader(dataset=train_dataset,
-                                       preprocess=model.preprocess,
-                                       transform=model.transform,
-                                       use_cache=dataset.cfg.use_cache,
-                                       steps_per_epoch=dataset.cfg.get(
-                                           'steps_per_epoch_train', None))
+        train_split = TorchDataloader(dataset=train_dataset,
+                                      preprocess=model.preprocess,
+                                      transform=model.transform,
+                                      use_cache=dataset.cfg.use_cache,
+                                      steps_per_epoch=dataset.cfg.get(
+                                          'steps_per_epoch_train', None))
+        train_loader = DataLoader(train_split,
+                                  batch_size=cfg.batch_size,
+                                  shuffle=True,
+                                  collate_fn=batcher.collate_fn,
+                                  **self.get_loader_cfg())
 
         self.optimizer, self.scheduler = model.get_optimizer(cfg.optimizer)
 
@@ -254,11 +285,11 @@ class ObjectDetection(BasePipeline):
             model.train()
 
             self.losses = {}
-            process_bar = tqdm(range(len(train_loader)), desc='training')
-            for i in process_bar:
-                data = train_loader[i]['data']
+            process_bar = tqdm(train_loader, desc='training')
+            for data in process_bar:
+                data.to(device)
 
-                results = model(data['point'])
+                results = model(data)
                 loss = model.loss(results, data)
                 loss_sum = sum(loss.values())
 
@@ -288,6 +319,24 @@ class ObjectDetection(BasePipeline):
             if epoch % cfg.save_ckpt_freq == 0:
                 self.save_ckpt(epoch)
 
+    def get_loader_cfg(self):
+        """Get the dataloader arguments from the pipeline config."""
+        cfg = self.cfg
+        # The shuffling and the seeds of the workers are drawn from the
+        # generator, which follows the seed of the pipeline.
+        generator = torch.Generator()
+        generator.manual_seed(int(self.rng.integers(2**62)))
+        return {
+            'num_workers':
+                cfg.get('num_workers', 0),
+            'pin_memory':
+                cfg.get('pin_memory', False) and self.device.type == 'cuda',
+            'generator':
+                generator,
+            'worker_init_fn':
+                worker_init_fn
+        }
+
     def save_logs(self, writer, epoch):
         for key, val in self.losses.items():
             writer.add_scalar("train/" + key, np.mean(val), epoch)
@@ -1,7 +1,9 @@
-import torch, pickle
+import torch, pickle, json
 import torch.nn as nn
+import torch.distributed as dist
 import numpy as np
 import logging
+import multiprocessing
 import sys
 import warnings
 
@@ -9,13 +11,14 @@ from datetime import datetime
 from tqdm import tqdm
 from torch.utils.tensorboard import SummaryWriter
 from torch.utils.data import Dataset, IterableDataset, DataLoader
+from torch.nn.parallel import DistributedDataParallel
 from pathlib import Path
 from sklearn.metrics import confusion_matrix
 
 from os.path import exists, join, isfile, dirname, abspath
 
 from .base_pipeline import BasePipeline
-from ..dataloaders import get_sampler, TorchDataloader, DefaultBatcher, ConcatBatcher
+from ..dataloaders import get_sampler, TorchDataloader, DefaultBatcher, ConcatBatcher, PackedBatches, worker_init_fn
 from ..utils import latest_torch_ckpt
 from ..modules.losses import SemSegLoss
 from ..modules.metrics import SemSegMetric
@@ -81,6 +84,10 @@ class SemanticSegmentation(BasePipeline):
             device: The device to be used for training.
             split: The dataset split to be used. In this example, we have used "train".
             train_sum_dir: The directory where the trainig summary is stored.
+            num_workers: The number of dataloader worker processes running the preprocess and transform of the model, 0 loads the data in the main process.
+            pin_memory: Indicates if batches are loaded into pinned memory for faster transfer to the GPU.
+            prefetch_factor: The number of batches loaded in advance by each worker.
+            log_every_n_steps: The interval in steps at which the running training loss and mIoU are shown, 0 only reports them at the end of the epoch. Reading them synchronizes with the device.
             
     **Returns:**
             class: The corresponding class.
@@ -107,6 +114,10 @@ class SemanticSegmentation(BasePipeline):
             device='gpu',
             split='train',
             train_sum_dir='train_log',
+            num_workers=0,
+            pin_memory=False,
+            prefetch_factor=2,
+            log_every_n_steps=0,
             **kwargs):
 
         super().__init__(model=model,
@@ -126,6 +137,10 @@ class SemanticSegmentation(BasePipeline):
                          device=device,
                          split=split,
                          train_sum_dir=train_sum_dir,
+                         num_workers=num_workers,
+                         pin_memory=pin_memory,
+                         prefetch_factor=prefetch_factor,
+                         log_every_n_steps=log_every_n_steps,
                          **kwargs)
 
     """
@@ -154,12 +169,14 @@ class SemanticSegmentation(BasePipeline):
         infer_loader = DataLoader(infer_split,
                                   batch_size=cfg.batch_size,
                                   sampler=get_sampler(infer_sampler),
-                                  collate_fn=batcher.collate_fn)
+                                  collate_fn=batcher.collate_fn,
+                                  **self.get_loader_cfg(infer_sampler))
 
         model.trans_point_sampler = infer_sampler.get_point_sampler()
         self.curr_cloud_id = -1
-        self.test_probs = []
-        self.test_labels = []
+        # Keyed by cloud id, as for run_test.
+        self.test_probs = {}
+        self.test_labels = {}
         self.ori_test_probs = []
         self.ori_test_labels = []
 
@@ -209,16 +226,19 @@ class SemanticSegmentation(BasePipeline):
         test_loader = DataLoader(test_split,
                                  batch_size=cfg.batch_size,
                                  sampler=get_sampler(test_sampler),
-                                 collate_fn=batcher.collate_fn)
+                                 collate_fn=batcher.collate_fn,
+                                 **self.get_loader_cfg(test_sampler))
 
         self.dataset_split = test_dataset
+        self.cache_convert = test_split.cache_convert
 
         self.load_ckpt(model.cfg.ckpt_path)
 
         model.trans_point_sampler = test_sampler.get_point_sampler()
         self.curr_cloud_id = -1
-        self.test_probs = []
-        self.test_labels = []
+        # Keyed by cloud id, each rank only tests its part of the clouds.
+        self.test_probs = {}
+        self.test_labels = {}
         self.ori_test_probs = []
         self.ori_test_labels = []
 
@@ -234,7 +254,7 @@ class SemanticSegmentation(BasePipeline):
                         'predict_labels': self.ori_test_labels.pop(),
                         'predict_scores': self.ori_test_probs.pop()
                     }
-                    attr = self.dataset_split.get_attr(test_sampler.cloud_id)
+                    attr = self.dataset_split.get_attr(self.curr_cloud_id)
                     dataset.save_test_result(inference_result, attr)
 
         log.info("Finshed testing")
@@ -247,21 +267,43 @@ class SemanticSegmentation(BasePipeline):
     def update_tests(self, sampler, inputs, results):
         split = sampler.split
         end_threshold = 0.5
-        if self.curr_cloud_id != sampler.cloud_id:
-            self.curr_cloud_id = sampler.cloud_id
-            num_points = sampler.possibilities[sampler.cloud_id].shape[0]
+        # The cloud sampler runs ahead of the batches loaded by the workers,
+        # so the cloud of a batch is taken from its attributes. Without
+        # workers the current cloud of the sampler is the same.
+        attr = inputs['attr']
+        if isinstance(attr, dict):
+            cloud_id = attr['idx'][-1] if 'idx' in attr else None
+        else:
+            cloud_id = attr[-1].get('idx', None)
+        if cloud_id is not None:
+            cloud_id = int(cloud_id)
+        elif self.cfg.get('num_workers', 0) == 0:
+            cloud_id = sampler.cloud_id
+        else:
+            raise KeyError("The attributes of the dataset need an 'idx' "
+                           "for testing with num_workers > 0")
+
+        if self.curr_cloud_id != cloud_id:
+            self.curr_cloud_id = cloud_id
+            num_points = sampler.get_possibilities(cloud_id).shape[0]
             self.pbar = tqdm(total=num_points,
                              desc="{} {}/{}".format(split, self.curr_cloud_id,
                                                     len(sampler.dataset)))
             self.pbar_update = 0
-            self.test_probs.append(
-                np.zeros(shape=[num_points, self.model.cfg.num_classes],
-                         dtype=np.float16))
-            self.test_labels.append(np.zeros(shape=[num_points],
-                                             dtype=np.int16))
+            self.test_probs[cloud_id] = np.zeros(
+                shape=[num_points, self.model.cfg.num_classes],
+                dtype=np.float16)
+            self.test_labels[cloud_id] = np.zeros(shape=[num_points],
+                                                  dtype=np.int16)
             self.complete_infer = False
+            self.cloud_done = False
 
-        this_possiblility = sampler.possibilities[sampler.cloud_id]
+        if self.cloud_done:
+            # Batch prefetched after the cloud was completed.
+            self.complete_infer = False
+            return
+
+        this_possiblility = sampler.get_possibilities(cloud_id)
         self.pbar.update(this_possiblility[this_possiblility > end_threshold].shape[0] \
             - self.pbar_update)
         self.pbar_update = this_possiblility[
@@ -274,14 +316,29 @@ class SemanticSegmentation(BasePipeline):
         if split in ['test'] and this_possiblility[this_possiblility > end_threshold].shape[0] \
           == this_possiblility.shape[0]:
 
-            proj_inds = self.model.preprocess(
-                self.dataset_split.get_data(self.curr_cloud_id),
-                {'split': split})['proj_inds']
+            proj_inds = self.get_proj_inds(self.curr_cloud_id, split)
             self.ori_test_probs.append(
                 self.test_probs[self.curr_cloud_id][proj_inds])
             self.ori_test_labels.append(
                 self.test_labels[self.curr_cloud_id][proj_inds])
             self.complete_infer = True
+            self.cloud_done = True
+
+    def get_proj_inds(self, cloud_id, split):
+        """Get the indices projecting a cloud on its preprocessed points.
+
+        They are read from the cache, where the preprocessing of the test
+        split stores them, and only computed again without a cache.
+        """
+        cache_convert = getattr(self, 'cache_convert', None)
+        if cache_convert is not None:
+            attr = self.dataset_split.get_attr(cloud_id)
+            proj_inds = cache_convert.get_field(attr['name'], 'proj_inds')
+            if proj_inds is not None:
+                return proj_inds
+
+        return self.model.preprocess(self.dataset_split.get_data(cloud_id),
+                                     {'split': split})['proj_inds']
 
     """
     Run the training on the self model.
@@ -297,31 +354,57 @@ class SemanticSegmentation(BasePipeline):
         cfg = self.cfg
         model.to(device)
 
+        # In an initialized process group each rank trains on its own part of
+        # the data, and rank 0 logs and saves the checkpoints.
+        self.rank, self.world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            self.rank = dist.get_rank()
+            self.world_size = dist.get_world_size()
+        if self.rank != 0:
+            log.setLevel(logging.WARNING)
+
         log.info("DEVICE : {}".format(device))
         timestamp = datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
 
-        log_file_path = join(cfg.logs_dir, 'log_train_' + timestamp + '.txt')
-        log.info("Logging in file : {}".format(log_file_path))
-        log.addHandler(logging.FileHandler(log_file_path))
+        if self.rank == 0:
+            log_file_path = join(cfg.logs_dir,
+                                 'log_train_' + timestamp + '.txt')
+            log.info("Logging in file : {}".format(log_file_path))
+            log.addHandler(logging.FileHandler(log_file_path))
 
         Loss = SemSegLoss(self, model, dataset, device)
-        metric = SemSegMetric(self, model, dataset, device)
+        self.metric_train = SemSegMetric(self, model, dataset, device)
+        self.metric_val = SemSegMetric(self, model, dataset, device)
 
         self.batcher = self.get_batcher(device)
 
         train_dataset = dataset.get_split('train')
         train_sampler = train_dataset.sampler
+        # Models taking several crops per cloud return that many samples per
+        # item, so fewer items make up a batch and an epoch.
+        crops_per_cloud = model.cfg.get('crops_per_cloud', 1)
+        steps_per_epoch = dataset.cfg.get('steps_per_epoch_train', None)
+        if crops_per_cloud > 1:
+            if steps_per_epoch is None:
+                steps_per_epoch = len(train_dataset)
+            steps_per_epoch = -(-steps_per_epoch // crops_per_cloud)
         train_split = TorchDataloader(dataset=train_dataset,
                                       preprocess=model.preprocess,
                                       transform=model.transform,
                                       sampler=train_sampler,
                                       use_cache=dataset.cfg.use_cache,
-                                      steps_per_epoch=dataset.cfg.get(
-                                          'steps_per_epoch_train', None))
+                                      steps_per_epoch=steps_per_epoch)
+        # Concatenated batches are packed up to the batch limit in the main
+        # process.
+        pack_batches = isinstance(self.batcher, ConcatBatcher) and \
+            model.cfg.get('pack_batches', True)
+        collate_fn = list if pack_batches else self.batcher.collate_fn
         train_loader = DataLoader(train_split,
-                                  batch_size=cfg.batch_size,
+                                  batch_size=max(
+                                      cfg.batch_size // crops_per_cloud, 1),
                                   sampler=get_sampler(train_sampler),
-                                  collate_fn=self.batcher.collate_fn)
+                                  collate_fn=collate_fn,
+                                  **self.get_loader_cfg(train_sampler))
 
         valid_dataset = dataset.get_split('validation')
         valid_sampler = valid_dataset.sampler
@@ -335,74 +418,114 @@ class SemanticSegmentation(BasePipeline):
         valid_loader = DataLoader(valid_split,
                                   batch_size=cfg.val_batch_size,
                                   sampler=get_sampler(valid_sampler),
-                                  collate_fn=self.batcher.collate_fn)
+                                  collate_fn=collate_fn,
+                                  **self.get_loader_cfg(valid_sampler))
+        if pack_batches:
+            # The ranks of a process group take the same number of steps.
+            train_loader = PackedBatches(train_loader,
+                                         self.batcher,
+                                         even_steps=True)
+            valid_loader = PackedBatches(valid_loader, self.batcher)
+
+        # Before the loaders start their workers, which copy the model.
+        self.calibrate(train_split, join(cfg.logs_dir, 'checkpoint'))
 
         self.optimizer, self.scheduler = model.get_optimizer(cfg)
 
-        is_resume = model.cfg.get('is_resume', True)
-        self.load_ckpt(model.cfg.ckpt_path, is_resume=is_resume)
-
-        dataset_name = dataset.name if dataset is not None else ''
-        tensorboard_dir = join(
-            self.cfg.train_sum_dir,
-            model.__class__.__name__ + '_' + dataset_name + '_torch')
-        runid = get_runid(tensorboard_dir)
-        self.tensorboard_dir = join(self.cfg.train_sum_dir,
-                                    runid + '_' + Path(tensorboard_dir).name)
+        # Saved with the checkpoints, to resume with the same crops.
+        self.samplers = {'train': train_sampler, 'valid': valid_sampler}
+        self.loader_generators = {
+            'train': train_loader.generator,
+            'valid': valid_loader.generator
+        }
 
-        writer = SummaryWriter(self.tensorboard_dir)
-        self.save_config(writer)
-        log.info("Writing summary in {}.".format(self.tensorboard_dir))
+        is_resume = model.cfg.get('is_resume', True)
+        ckpt_epoch = self.load_ckpt(model.cfg.ckpt_path, is_resume=is_resume)
+        start_epoch = 0
+        if is_resume and ckpt_epoch is not None:
+            start_epoch = ckpt_epoch + 1
+
+        # The forward pass goes through the wrapper, so that the backward
+        # pass of the loss averages the gradients over the ranks.
+        train_model = model
+        if self.world_size > 1:
+            train_model = DistributedDataParallel(model)
+
+        writer = None
+        if self.rank == 0:
+            dataset_name = dataset.name if dataset is not None else ''
+            tensorboard_dir = join(
+                self.cfg.train_sum_dir,
+                model.__class__.__name__ + '_' + dataset_name + '_torch')
+            runid = get_runid(tensorboard_dir)
+            self.tensorboard_dir = join(
+                self.cfg.train_sum_dir,
+                runid + '_' + Path(tensorboard_dir).name)
+
+            writer = SummaryWriter(self.tensorboard_dir)
+            self.save_config(writer)
+            log.info("Writing summary in {}.".format(self.tensorboard_dir))
 
         log.info("Started training")
+        log_every_n_steps = cfg.get('log_every_n_steps', 0)
 
-        for epoch in range(0, cfg.max_epoch + 1):
+        for epoch in range(start_epoch, cfg.max_epoch + 1):
 
             log.info(f'=== EPOCH {epoch:d}/{cfg.max_epoch:d} ===')
             model.train()
             self.losses = []
-            self.accs = []
-            self.ious = []
-            self.train_conf_m = []
+            self.metric_train.reset()
             model.trans_point_sampler = train_sampler.get_point_sampler()
 
-            for step, inputs in enumerate(tqdm(train_loader, desc='training')):
-                results = model(inputs['data'])
+            process_bar = tqdm(train_loader,
+                               desc='training',
+                               disable=self.rank != 0)
+            for step, inputs in enumerate(process_bar):
+                results = train_model(inputs['data'])
                 loss, gt_labels, predict_scores = model.get_loss(
                     Loss, results, inputs, device)
 
-                if predict_scores.size()[-1] == 0:
+                no_labels = predict_scores.size()[-1] == 0
+                if no_labels and self.world_size == 1:
                     continue
+                elif no_labels:
+                    # The other ranks wait for the gradients of this one in
+                    # the backward pass, it contributes zero gradients.
+                    loss = 0 * results.sum()
 
                 self.optimizer.zero_grad()
-                # loss.backward()
+                loss.backward()
                 if model.cfg.get('grad_clip_norm', -1) > 0:
                     torch.nn.utils.clip_grad_value_(model.parameters(),
                                                     model.cfg.grad_clip_norm)
                 self.optimizer.step()
+                if no_labels:
+                    continue
 
-                conf_m = metric.confusion_matrix(predict_scores, gt_labels)
-                acc = metric.acc(predict_scores, gt_labels)
-                iou = metric.iou(predict_scores, gt_labels)
+                # Kept on the device, read at log intervals only.
+                self.metric_train.update(predict_scores, gt_labels)
+                self.losses.append(loss.detach())
 
-                self.losses.append(loss.cpu().item())
-                self.accs.append(acc)
-                self.ious.append(iou)
-                self.train_conf_m.append(conf_m)
+                if log_every_n_steps > 0 and \
+                        (step + 1) % log_every_n_steps == 0:
+                    running_loss = torch.stack(
+                        self.losses[-log_every_n_steps:]).mean()
+                    process_bar.set_postfix(loss=running_loss.item(),
+                                            miou=self.metric_train.iou()[-1])
 
             self.scheduler.step()
 
             # --------------------- validation
             model.eval()
             self.valid_losses = []
-            self.valid_accs = []
-            self.valid_ious = []
-            self.valid_conf_m = []
+            self.metric_val.reset()
 
             model.trans_point_sampler = valid_sampler.get_point_sampler()
             with torch.no_grad():
                 for step, inputs in enumerate(
-                        tqdm(valid_loader, desc='validation')):
+                        tqdm(valid_loader,
+                             desc='validation',
+                             disable=self.rank != 0)):
                     results = model(inputs['data'])
                     loss, gt_labels, predict_scores = model.get_loss(
                         Loss, results, inputs, device)
@@ -410,20 +533,43 @@ class SemanticSegmentation(BasePipeline):
                     if predict_scores.size()[-1] == 0:
                         continue
 
-                    conf_m = metric.confusion_matrix(predict_scores, gt_labels)
-                    acc = metric.acc(predict_scores, gt_labels)
-                    iou = metric.iou(predict_scores, gt_labels)
-
-                    self.valid_losses.append(loss.cpu().item())
-                    self.valid_accs.append(acc)
-                    self.valid_ious.append(iou)
-                    self.valid_conf_m.append(conf_m)
+                    self.metric_val.update(predict_scores, gt_labels)
+                    self.valid_losses.append(loss.detach())
 
             self.save_logs(writer, epoch)
 
             if epoch % cfg.save_ckpt_freq == 0:
                 self.save_ckpt(epoch)
 
+    """
+    Get the dataloader arguments from the pipeline config.
+    
+    """
+
+    def get_loader_cfg(self, sampler=None):
+        cfg = self.cfg
+        num_workers = cfg.get('num_workers', 0)
+        loader_cfg = {
+            'num_workers':
+                num_workers,
+            'pin_memory':
+                cfg.get('pin_memory', False) and self.device.type == 'cuda'
+        }
+        if num_workers > 0:
+            loader_cfg['prefetch_factor'] = cfg.get('prefetch_factor', 2)
+            # The spatially regular sampler is shared with forked workers.
+            if 'fork' in multiprocessing.get_all_start_methods():
+                loader_cfg['multiprocessing_context'] = 'fork'
+        if sampler is not None:
+            # The seeds of the workers are drawn from the generator, which
+            # follows the seed of the sampler.
+            generator = torch.Generator()
+            seed = int(sampler.rng.integers(2**62))
+            generator.manual_seed(seed + getattr(self, 'rank', 0))
+            loader_cfg['generator'] = generator
+            loader_cfg['worker_init_fn'] = worker_init_fn
+        return loader_cfg
+
     """
     Get the batcher to be used based on the device and split.
     
@@ -448,30 +594,38 @@ class SemanticSegmentation(BasePipeline):
 
     def save_logs(self, writer, epoch):
 
+        if self.world_size > 1:
+            # Sum the statistics of all ranks.
+            self.metric_train.all_reduce()
+            self.metric_val.all_reduce()
+
+        # Metrics of the confusion matrices accumulated over the epoch.
         with warnings.catch_warnings():  # ignore Mean of empty slice.
             warnings.simplefilter('ignore', category=RuntimeWarning)
-            accs = np.nanmean(np.array(self.accs), axis=0)
-            ious = np.nanmean(np.array(self.ious), axis=0)
+            accs = self.metric_train.acc()
+            ious = self.metric_train.iou()
 
-            valid_accs = np.nanmean(np.array(self.valid_accs), axis=0)
-            valid_ious = np.nanmean(np.array(self.valid_ious), axis=0)
+            valid_accs = self.metric_val.acc()
+            valid_ious = self.metric_val.iou()
 
-        valid_conf_m = np.array(self.valid_conf_m).sum(0)
-        valid_total_acc = np.sum(np.diag(valid_conf_m)) / np.sum(valid_conf_m)
-        valid_total_iou = np.nanmean([valid_conf_m[i][i] / \
-            (valid_conf_m[i].sum() + valid_conf_m[:,i].sum() - valid_conf_m[i][i]) \
-          for i in range(valid_conf_m.shape[0])])
+            # NaN for an empty epoch.
+            valid_conf_m = self.metric_val.conf_m.cpu().numpy()
+            valid_total_acc = np.sum(
+                np.diag(valid_conf_m)) / np.sum(valid_conf_m)
+            valid_total_iou = valid_ious[-1]
 
-        train_conf_m = np.array(self.train_conf_m).sum(0)
-        train_total_acc = np.sum(np.diag(train_conf_m)) / np.sum(train_conf_m)
-        train_total_iou = np.nanmean([train_conf_m[i][i] / \
-            (train_conf_m[i].sum() + train_conf_m[:,i].sum() - train_conf_m[i][i]) \
-          for i in range(train_conf_m.shape[0])])
+            train_conf_m = self.metric_train.conf_m.cpu().numpy()
+            train_total_acc = np.sum(
+                np.diag(train_conf_m)) / np.sum(train_conf_m)
+            train_total_iou = ious[-1]
 
         loss_dict = {
-            'Training loss': np.mean(self.losses),
-            'Validation loss': np.mean(self.valid_losses)
+            'Training loss': self.get_mean_loss(self.losses),
+            'Validation loss': self.get_mean_loss(self.valid_losses)
         }
+        if self.rank != 0:
+            return
+
         acc_dicts = [{
             'Training accuracy': acc,
             'Validation accuracy': val_acc
@@ -501,9 +655,109 @@ class SemanticSegmentation(BasePipeline):
                  f" eval: {iou_dicts[-1]['Validation IoU']:.3f}")
         log.info(f"total iou train: {train_total_iou:.3f} "
                  f" eval: {valid_total_iou:.3f}")
-        log.info(f"total acc train: {valid_total_acc:.3f} "
+        log.info(f"total acc train: {train_total_acc:.3f} "
                  f" eval: {valid_total_acc:.3f}")
 
+    """
+    Get the mean of the losses of all ranks.
+    
+    """
+
+    def get_mean_loss(self, losses):
+        # A rank without losses still takes part in the reduction.
+        stats = torch.zeros(2, device=self.device)
+        if losses:
+            losses = torch.stack(losses)
+            stats = torch.stack([losses.sum(), losses.new_tensor(len(losses))])
+        if self.world_size > 1:
+            dist.all_reduce(stats)
+        if stats[1] == 0:
+            return float('nan')
+        return (stats[0] / stats[1]).item()
+
+    """
+    Calibrate the model on a split, or load the calibration saved in the checkpoint directory.
+    
+    """
+
+    def calibrate(self, split, ckpt_dir):
+        model = self.model
+        calibrate_neighbors = hasattr(
+            model, 'calibrate_neighborhood_limits') and model.cfg.get(
+                'neighborhood_limit_ratio', 0.9) is not None
+        calibrate_batch_limit = hasattr(
+            model, 'calibrate_batch_limit') and model.cfg.get(
+                'calibrate_batch_limit', False)
+        if not calibrate_neighbors and not calibrate_batch_limit:
+            return
+
+        calibration = [{}]
+        path = join(ckpt_dir, 'calibration.json')
+        if self.rank == 0 and exists(path):
+            with open(path, 'r') as f:
+                calibration[0] = json.load(f)
+
+        calibrate_neighbors &= 'neighborhood_limits' not in calibration[0]
+        calibrate_batch_limit &= 'batch_limit' not in calibration[0]
+        if self.rank == 0 and (calibrate_neighbors or calibrate_batch_limit):
+            # The crops are drawn by a sampler of their own, so that the
+            # sampler of the split is left as is.
+            sampler = split.sampler.__class__(split.dataset)
+            sampler.initialize_with_dataloader(split)
+            trans_point_sampler = getattr(model, 'trans_point_sampler', None)
+            model.trans_point_sampler = sampler.get_point_sampler()
+
+            num_points = []
+
+            def get_samples():
+                for idx in sampler.get_cloud_sampler():
+                    data = split[idx]['data']
+                    num_points.append(sum(p.shape[0] for p in data['p_list']))
+                    yield data
+
+            samples = tqdm(get_samples(), desc='calibration')
+            if calibrate_neighbors:
+                calibration[0]['neighborhood_limits'] = \
+                    model.calibrate_neighborhood_limits(samples)
+            else:
+                for _ in zip(range(100), samples):
+                    pass
+            if calibrate_batch_limit:
+                # Batches of the training batch size on average.
+                calibration[0]['batch_limit'] = model.calibrate_batch_limit(
+                    num_points, self.cfg.batch_size)
+            model.trans_point_sampler = trans_point_sampler
+
+            make_dir(ckpt_dir)
+            with open(path, 'w') as f:
+                json.dump(calibration[0], f)
+
+        # All ranks use the calibration of rank 0.
+        if self.world_size > 1:
+            dist.broadcast_object_list(calibration, src=0)
+        self.set_calibration(calibration[0])
+
+    """
+    Load the calibration saved next to the checkpoints, if any.
+    
+    """
+
+    def load_calibration(self, ckpt_dir):
+        path = join(ckpt_dir, 'calibration.json')
+        if exists(path):
+            with open(path, 'r') as f:
+                self.set_calibration(json.load(f))
+
+    def set_calibration(self, calibration):
+        model = self.model
+        if 'neighborhood_limits' in calibration:
+            model.neighborhood_limits = calibration['neighborhood_limits']
+            log.info("Neighborhood limits: {}".format(
+                model.neighborhood_limits))
+        if 'batch_limit' in calibration:
+            model.cfg.batch_limit = calibration['batch_limit']
+            log.info("Batch limit: {}".format(model.cfg.batch_limit))
+
     """
     Load a checkpoint. You must pass the checkpoint and indicate if you want to resume.
     
@@ -527,12 +781,28 @@ class SemanticSegmentation(BasePipeline):
         log.info(f'Loading checkpoint {ckpt_path}')
         ckpt = torch.load(ckpt_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model_state_dict'])
+        self.load_calibration(dirname(ckpt_path))
         if 'optimizer_state_dict' in ckpt and hasattr(self, 'optimizer'):
             log.info(f'Loading checkpoint optimizer_state_dict')
             self.optimizer.load_state_dict(ckpt['optimizer_state_dict'])
         if 'scheduler_state_dict' in ckpt and hasattr(self, 'scheduler'):
             log.info(f'Loading checkpoint scheduler_state_dict')
             self.scheduler.load_state_dict(ckpt['scheduler_state_dict'])
+        if 'sampler_state_dict' in ckpt and hasattr(self, 'samplers'):
+            # The checkpoint holds the samplers of each rank.
+            sampler_states = ckpt['sampler_state_dict']
+            generator_states = ckpt['generator_state_dict']
+            if len(sampler_states) == self.world_size:
+                log.info(f'Loading checkpoint sampler_state_dict')
+                for split, state_dict in sampler_states[self.rank].items():
+                    self.samplers[split].load_state_dict(state_dict)
+                for split, state in generator_states[self.rank].items():
+                    self.loader_generators[split].set_state(state)
+            else:
+                log.warning(f'Not loading the sampler_state_dict of '
+                            f'{len(sampler_states)} ranks')
+
+        return ckpt.get('epoch', None)
 
     """
     Save a checkpoint at the passed epoch.
@@ -542,11 +812,31 @@ class SemanticSegmentation(BasePipeline):
     def save_ckpt(self, epoch):
         path_ckpt = join(self.cfg.logs_dir, 'checkpoint')
         make_dir(path_ckpt)
+        sampler_state_dict = {
+            split: sampler.state_dict()
+            for split, sampler in self.samplers.items()
+        }
+        generator_state_dict = {
+            split: generator.get_state()
+            for split, generator in self.loader_generators.items()
+        }
+
+        # The samplers differ between the ranks, rank 0 saves them all.
+        states = [(sampler_state_dict, generator_state_dict)]
+        if self.world_size > 1:
+            states = [None] * self.world_size
+            dist.all_gather_object(states,
+                                   (sampler_state_dict, generator_state_dict))
+        if self.rank != 0:
+            return
+
         torch.save(
             dict(epoch=epoch,
                  model_state_dict=self.model.state_dict(),
                  optimizer_state_dict=self.optimizer.state_dict(),
-                 scheduler_state_dict=self.scheduler.state_dict()),
+                 scheduler_state_dict=self.scheduler.state_dict(),
+                 sampler_state_dict=[s for s, _ in states],
+                 generator_state_dict=[g for _, g in states]),
             join(path_ckpt, f'ckpt_{epoch:05d}.pth'))
         log.info(f'Epoch {epoch:3d}: save ckpt to {path_ckpt:s}')
 
@@ -4,10 +4,12 @@ from .config import Config
 from .log import LogRecord, get_runid, code2md
 from .builder import (MODEL, PIPELINE, DATASET, SAMPLER, get_module,
                       convert_framework_name, convert_device_name)
-from .dataset_helper import get_hash, make_dir, Cache
+from .dataset_helper import (get_hash, get_cache_key, make_dir, Cache,
+                             save_kdtree, load_kdtree)
 
 __all__ = [
     'Config', 'make_dir', 'LogRecord', 'MODEL', 'SAMPLER', 'PIPELINE',
     'DATASET', 'get_module', 'convert_framework_name', 'get_hash', 'make_dir',
-    'Cache', 'convert_device_name'
+    'Cache', 'convert_device_name', 'save_kdtree', 'load_kdtree',
+    'get_cache_key'
 ]
@@ -1,10 +1,28 @@
 import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+from collections import OrderedDict
+from multiprocessing import Pool
 from pathlib import Path
 from typing import Callable
 import numpy as np
+import sklearn
+from sklearn.neighbors import KDTree
+from tqdm import tqdm
 
 from os import makedirs, listdir
-from os.path import exists, join, isfile, dirname, abspath, splitext
+from os.path import exists, join, isfile, isdir, dirname, abspath, splitext
+
+log = logging.getLogger(__name__)
+
+# Version of the cache format and of the shared preprocessing code. Bump it to
+# invalidate all existing caches.
+CACHE_VERSION = 1
 
 
 def make_dir(folder_name):
@@ -19,12 +37,204 @@ def get_hash(x: str):
     return h.hexdigest()
 
 
+def get_cache_key(preprocess: Callable):
+    """
+    Generate a cache key for a preprocess function that is stable across runs.
+
+    The key is derived from the model class, the config fields listed in the
+    preprocess_cfg_keys attribute of the model (the whole model config if the
+    model does not define it), the source code of the preprocess function and
+    CACHE_VERSION. It does not depend on the memory address of the model, so
+    the cache is reused after a restart.
+
+    Args:
+        preprocess: preprocess function, usually a bound method of a model.
+    Returns:
+        The cache key, prefixed with the model name.
+    """
+    model = getattr(preprocess, '__self__', None)
+    if model is None:
+        name = preprocess.__qualname__
+        cfg = {}
+    else:
+        name = model.__class__.__name__
+        keys = getattr(model, 'preprocess_cfg_keys', None)
+        if keys is None:
+            cfg = dict(model.cfg.cfg_dict)
+        else:
+            cfg = {key: model.cfg.get(key, None) for key in keys}
+
+    try:
+        code = inspect.getsource(preprocess)
+    except (OSError, TypeError):
+        code = ''
+
+    desc = json.dumps(
+        {
+            'name': name,
+            'cfg': cfg,
+            'code': code,
+            'version': CACHE_VERSION
+        },
+        sort_keys=True,
+        default=str)
+    return '{}_{}'.format(name, get_hash(desc))
+
+
+def save_kdtree(tree: KDTree, path: str):
+    """
+    Save a KDTree as raw node arrays that can be memory-mapped on load.
+
+    The arrays of the tree state (points, index permutation, node data and
+    node bounds) are written as ``.npy`` files, the remaining scalar entries
+    of the state go to a small ``state.pkl`` header.
+
+    Args:
+        tree: sklearn KDTree to save.
+        path: directory to store the tree.
+    """
+    make_dir(path)
+    state = []
+    for i, value in enumerate(tree.__getstate__()):
+        if isinstance(value, np.ndarray):
+            np.save(join(path, '{}.npy'.format(i)), value)
+            state.append(('array', value.size))
+        else:
+            state.append(('value', value))
+
+    header = {'sklearn_version': sklearn.__version__, 'state': state}
+    with open(join(path, 'state.pkl'), 'wb') as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_kdtree(path: str, mmap: bool = True):
+    """
+    Load a KDTree saved with save_kdtree without rebuilding it.
+
+    The node arrays are memory-mapped read-only, so the tree can be shared
+    between DataLoader worker processes through the page cache. If the tree
+    was written by another sklearn version, it is rebuilt from its points.
+
+    Args:
+        path: directory of the saved tree.
+        mmap: memory-map the arrays instead of reading them into RAM.
+    Returns:
+        The KDTree.
+    """
+    with open(join(path, 'state.pkl'), 'rb') as f:
+        header = pickle.load(f)
+
+    state = []
+    for i, (kind, value) in enumerate(header['state']):
+        if kind == 'array':
+            mmap_mode = 'r' if mmap and value > 0 else None
+            value = np.load(join(path, '{}.npy'.format(i)), mmap_mode=mmap_mode)
+        state.append(value)
+
+    if header['sklearn_version'] != sklearn.__version__:
+        # The layout of the tree state is private to sklearn.
+        return KDTree(np.array(state[0]))
+
+    tree = KDTree.__new__(KDTree)
+    tree.__setstate__(tuple(state))
+    return tree
+
+
+_warmup_state = None
+
+
+def _warmup_init(cache, dataset):
+    global _warmup_state
+    _warmup_state = (cache, dataset)
+
+
+def _warmup_sample(idx):
+    cache, dataset = _warmup_state
+    attr = dataset.get_attr(idx)
+    name = str(attr['name'])
+    source = _source_stat(attr.get('path', None))
+    cache._store(name, dataset.get_data(idx), attr, source=source)
+    return name, cache._index.get(name, {})
+
+
+def _index_record(meta):
+    """Entry of the cache index for the manifest of a sample."""
+    point = meta['fields'].get('point', None) or {}
+    shape = point.get('shape', None)
+    return {
+        'source': meta['source'],
+        'num_points': shape[0] if shape else None,
+        'class_counts': meta.get('class_counts', None)
+    }
+
+
+def _class_counts(label):
+    """Number of points of each class, or None for non class labels."""
+    if not isinstance(label, np.ndarray) or label.dtype.kind not in 'iub':
+        return None
+    if label.size == 0 or label.min() < 0:
+        return None
+    return np.bincount(label.ravel()).tolist()
+
+
+def _source_stat(path):
+    """Size and modification time of the source file of a sample."""
+    if path is None or not isfile(str(path)):
+        return None
+    stat = os.stat(str(path))
+    return [stat.st_size, stat.st_mtime]
+
+
+def _nbytes(x):
+    """Size in bytes of the arrays of a preprocessed sample."""
+    nbytes = 0
+    for value in x.values():
+        if isinstance(value, np.ndarray):
+            nbytes += value.nbytes
+        elif isinstance(value, KDTree):
+            nbytes += sum(v.nbytes
+                          for v in value.__getstate__()
+                          if isinstance(v, np.ndarray))
+    return nbytes
+
+
+def _dir_nbytes(path):
+    """Size in bytes of the files of a cached sample."""
+    nbytes = 0
+    for root, _, files in os.walk(path):
+        nbytes += sum(os.stat(join(root, f)).st_size for f in files)
+    return nbytes
+
+
 class Cache(object):
     """
     Cache converter for preprocessed data.
+
+    Every sample is stored in its own directory under the cache dir. Array
+    fields of the preprocessed dict (e.g. point, feat, label, proj_inds) are
+    written as raw ``.npy`` files and read back with ``np.load(mmap_mode='r')``,
+    so loading a sample only maps the files instead of deserializing the whole
+    scene. KDTree fields are saved with save_kdtree and memory-mapped as well,
+    other fields are pickled next to the arrays. A small ``meta.json``
+    manifest records the field layout of the sample.
+
+    The cached samples are listed in an append-only ``index.jsonl`` file in
+    the cache dir, which also records their source file and number of points.
+    Loading it replaces listing the cache dir, and ``cached_ids`` is a set, so
+    membership queries stay O(1) for large datasets.
+
+    An optional RAM tier keeps recently used samples in memory, bounded by
+    their size in bytes and evicted in LRU order. ``hits`` and ``misses``
+    count the lookups of the RAM tier.
     """
 
-    def __init__(self, func: Callable, cache_dir: str, cache_key: str):
+    def __init__(self,
+                 func: Callable,
+                 cache_dir: str,
+                 cache_key: str,
+                 mmap: bool = True,
+                 mem_size: int = 0,
+                 shm_dir: str = None):
         """
         Initialize
 
@@ -32,15 +242,34 @@ class Cache(object):
             func: preprocess function of a model.
             cache_dir: directory to store the cache.
             cache_key: key of this cache
+            mmap: memory-map the cached arrays instead of reading them into RAM.
+            mem_size: size in bytes of the RAM tier in front of the disk cache.
+                Samples are evicted in LRU order. 0 disables the RAM tier.
+            shm_dir: optional directory on a shared memory filesystem (e.g.
+                /dev/shm). If given, the RAM tier keeps its samples there
+                instead of in the process heap, so it is shared between
+                DataLoader workers.
         Returns:
             class: The corresponding class.
         """
         self.func = func
         self.cache_dir = join(cache_dir, cache_key)
+        self.mmap = mmap
         make_dir(self.cache_dir)
-        self.cached_ids = [splitext(p)[0] for p in listdir(self.cache_dir)]
+        self.index_path = join(self.cache_dir, 'index.jsonl')
+        self._index = self._load_index()
+        self.cached_ids = set(self._index)
 
-    def __call__(self, unique_id: str, *data):
+        self.mem_size = mem_size
+        self.shm_dir = join(shm_dir, cache_key) if shm_dir else None
+        self.hits = 0
+        self.misses = 0
+        self._mem = OrderedDict()
+        self._mem_bytes = 0
+        if self.shm_dir is not None and mem_size > 0:
+            make_dir(self.shm_dir)
+
+    def __call__(self, unique_id: str, *data, source_path: str = None):
         """
         Call the converter. If the cache exists, load and return the cache,
         otherwise run the preprocess function and store the cache
@@ -48,23 +277,385 @@ class Cache(object):
         Args:
             unique_id: A unique key of this data.
             data: Input to the preprocess function.
+            source_path: Source file of the data (attr['path']). Its size and
+                modification time are stored with the sample, so that warmup
+                preprocesses it again when the file changes.
         Returns:
             class: Preprocessed (cache) data.
         """
-        fpath = join(self.cache_dir, str('{}.npy'.format(unique_id)))
+        unique_id = str(unique_id)
+        if self.mem_size > 0 and unique_id in self._mem:
+            self.hits += 1
+            self._mem.move_to_end(unique_id)
+            # Shallow copy, so callers may replace the fields of the sample.
+            return dict(self._mem[unique_id])
+
+        fpath = join(self.cache_dir, unique_id)
+        source = None
+        if unique_id not in self.cached_ids:
+            source = _source_stat(source_path)
+        if self._store(unique_id, *data, source=source):
+            self.cached_ids.add(unique_id)
+
+        if self.mem_size <= 0 or not isdir(fpath):
+            return self._read(fpath)
+        elif self.shm_dir is not None:
+            return self._read_shared(unique_id, fpath)
+
+        self.misses += 1
+        output = self._read(fpath, mmap=False)
+        for value in output.values():
+            if isinstance(value, np.ndarray):
+                # Shared by every later hit, same as the memory-mapped arrays.
+                value.flags.writeable = False
+        nbytes = _nbytes(output)
+        if nbytes <= self.mem_size:
+            self._mem[unique_id] = output
+            self._mem_bytes += nbytes
+            while self._mem_bytes > self.mem_size:
+                _, evicted = self._mem.popitem(last=False)
+                self._mem_bytes -= _nbytes(evicted)
+
+        return dict(output)
+
+    def _read_shared(self, unique_id, fpath):
+        """Read a sample through the RAM tier on the shared filesystem.
+
+        Other workers may evict the sample at any time, it is then read from
+        the disk cache. Entries used since the start of this call are never
+        evicted.
+        """
+        start = time.time()
+        spath = join(self.shm_dir, unique_id)
+        try:
+            if self._exists(spath):
+                # The directory mtime orders the shared tier for eviction.
+                os.utime(spath)
+                x = self._read(spath)
+                self.hits += 1
+                return x
+        except FileNotFoundError:
+            pass
 
-        if not exists(fpath):
-            output = self.func(*data)
+        self.misses += 1
+        nbytes = _dir_nbytes(fpath)
+        if nbytes > self.mem_size:
+            return self._read(fpath)
 
-            self._write(output, fpath)
-            self.cached_ids.append(unique_id)
+        tmp_path = spath + '.tmp{}'.format(os.getpid())
+        shutil.copytree(fpath, tmp_path)
+        try:
+            os.rename(tmp_path, spath)
+        except OSError:
+            # Another worker inserted the sample in the meantime.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        try:
+            os.utime(spath)
+        except FileNotFoundError:
+            pass
+
+        self._evict(start)
+        try:
+            return self._read(spath)
+        except FileNotFoundError:
+            return self._read(fpath)
+
+    def _evict(self, start):
+        """Evict the least recently used samples of the shared RAM tier."""
+        entries = []
+        for p in listdir(self.shm_dir):
+            if '.tmp' in p:
+                continue
+            path = join(self.shm_dir, p)
+            try:
+                entries.append(
+                    (os.stat(path).st_mtime, _dir_nbytes(path), path))
+            except FileNotFoundError:
+                # Evicted by another worker in the meantime.
+                continue
+
+        entries.sort()
+        total = sum(nbytes for _, nbytes, _ in entries)
+        for mtime, nbytes, path in entries:
+            if total <= self.mem_size or mtime >= start:
+                break
+            total -= nbytes
+            # Workers which mapped the sample keep their mapping.
+            shutil.rmtree(path, ignore_errors=True)
+
+    def missing(self, names):
+        """
+        Get the names of the samples which are not cached.
+
+        Args:
+            names: Iterable of sample names.
+        Returns:
+            List of the names not in the cache.
+        """
+        return [name for name in names if str(name) not in self.cached_ids]
+
+    def num_points(self, unique_id):
+        """
+        Get the number of points of a cached sample from the index.
+
+        Args:
+            unique_id: A unique key of this data.
+        Returns:
+            The number of points, or None if unknown.
+        """
+        return self._index.get(str(unique_id), {}).get('num_points', None)
+
+    def class_counts(self, unique_id):
+        """
+        Get the number of points of each class of a cached sample.
+
+        Args:
+            unique_id: A unique key of this data.
+        Returns:
+            List with the number of points of each label, or None if unknown.
+        """
+        return self._index.get(str(unique_id), {}).get('class_counts', None)
+
+    def get_field(self, unique_id, key):
+        """
+        Read a single field of a cached sample, e.g. its proj_inds.
+
+        Only the file of the field is read (memory-mapped for arrays), the
+        rest of the sample is not loaded.
+
+        Args:
+            unique_id: A unique key of this data.
+            key: Name of the field in the preprocessed dict.
+        Returns:
+            The field, or None if the sample is not cached or has no such
+            field.
+        """
+        unique_id = str(unique_id)
+        if unique_id in self._mem:
+            return self._mem[unique_id].get(key, None)
+
+        fpath = join(self.cache_dir, unique_id)
+        if not exists(join(fpath, 'meta.json')):
+            if exists(fpath + '.npy'):
+                return self._read(fpath).get(key, None)
+            return None
+
+        with open(join(fpath, 'meta.json'), 'r') as f:
+            info = json.load(f)['fields'].get(key, None)
+        return self._read_field(fpath, key, info, self.mmap)
+
+    def warmup(self, dataset, num_workers=0, check_stale=False):
+        """
+        Preprocess and store every uncached sample of a dataset split.
+
+        Samples are written to a temporary directory and renamed into place,
+        so an interrupted warm-up leaves no partial entries and is resumed by
+        the next call. With check_stale, cached samples whose source file
+        (attr['path']) changed size or modification time since they were
+        stored are preprocessed again. This stats the source file of every
+        sample, so it is off by default.
+
+        Args:
+            dataset: The dataset split, providing get_data and get_attr.
+            num_workers: Number of worker processes. 0 preprocesses the
+                samples in the calling process.
+            check_stale: Preprocess again the samples whose source changed.
+        """
+        attrs = [dataset.get_attr(idx) for idx in range(len(dataset))]
+        names = [str(attr['name']) for attr in attrs]
+        missing = set(self.missing(names))
+
+        num_stale = 0
+        if check_stale:
+            for name, attr in zip(names, attrs):
+                if name in missing or not self._is_stale(
+                        name, attr.get('path', None)):
+                    continue
+                self._remove(name)
+                missing.add(name)
+                num_stale += 1
+        uncached = [idx for idx, name in enumerate(names) if name in missing]
+
+        log.info("Cache {}: {} valid, {} stale, {} new samples".format(
+            self.cache_dir,
+            len(dataset) - len(uncached), num_stale,
+            len(uncached) - num_stale))
+        if len(uncached) == 0:
+            return
+
+        start = time.time()
+        if num_workers > 0:
+            pool = Pool(num_workers,
+                        initializer=_warmup_init,
+                        initargs=(self, dataset))
+            names = pool.imap_unordered(_warmup_sample, uncached)
         else:
-            output = self._read(fpath)
+            _warmup_init(self, dataset)
+            names = map(_warmup_sample, uncached)
+
+        for name, record in tqdm(names, total=len(uncached), desc='preprocess'):
+            self._index[name] = record
+            self.cached_ids.add(name)
+
+        if num_workers > 0:
+            pool.close()
+            pool.join()
+
+        duration = time.time() - start
+        log.info("Preprocessed {} samples in {:.1f}s ({:.2f} samples/s)".format(
+            len(uncached), duration,
+            len(uncached) / max(duration, 1e-6)))
+
+    def _is_stale(self, unique_id, source_path):
+        """Check if the source file of a sample changed since it was stored."""
+        stored = self._index[unique_id].get('source', None)
+        if stored is None:
+            return False
+        return stored != _source_stat(source_path)
+
+    def _load_index(self):
+        """Load the index of the cache, or rebuild it from the cache dir."""
+        index = dict()
+        if exists(self.index_path):
+            num_lines = 0
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    # Skip a line truncated by an interrupted write.
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    num_lines += 1
+                    name = record.pop('name')
+                    if record.get('removed', False):
+                        index.pop(name, None)
+                    else:
+                        index[name] = record
+            if num_lines <= 2 * len(index):
+                return index
+        else:
+            for p in listdir(self.cache_dir):
+                fpath = join(self.cache_dir, p)
+                if '.tmp' in p or p == 'index.jsonl':
+                    continue
+                elif not isdir(fpath):
+                    # Cache entry written by the former single-file format.
+                    index[splitext(p)[0]] = {}
+                elif exists(join(fpath, 'meta.json')):
+                    with open(join(fpath, 'meta.json'), 'r') as f:
+                        index[p] = _index_record(json.load(f))
+
+        # Compact the index, readers see either the old or the new file.
+        tmp_path = self.index_path + '.tmp{}'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            for name, record in index.items():
+                f.write(json.dumps(dict(record, name=name)) + '\n')
+        os.replace(tmp_path, self.index_path)
+        return index
+
+    def _append_index(self, name, record):
+        # Small appends are atomic, so processes can share the index file.
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(dict(record, name=name)) + '\n')
+
+    def _remove(self, unique_id):
+        """Remove a sample from the cache."""
+        shutil.rmtree(join(self.cache_dir, unique_id), ignore_errors=True)
+        self._append_index(unique_id, {'removed': True})
+        self._index.pop(unique_id, None)
+        self.cached_ids.discard(unique_id)
+
+    def _store(self, unique_id, *data, source=None):
+        """
+        Run the preprocess function and store the result if not cached.
 
-        return self._read(fpath)
+        Args:
+            unique_id: A unique key of this data.
+            data: Input to the preprocess function.
+            source: Size and modification time of the source file.
+
+        Returns:
+            True if the sample was preprocessed, False if it was cached.
+        """
+        fpath = join(self.cache_dir, unique_id)
+        if self._exists(fpath):
+            return False
+
+        output = self.func(*data)
+
+        tmp_path = fpath + '.tmp{}'.format(os.getpid())
+        meta = self._write(output, tmp_path, source=source)
+        try:
+            os.rename(tmp_path, fpath)
+        except OSError:
+            # Stored and appended to the index file by another process in
+            # the meantime, only its record is added here.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            with open(join(fpath, 'meta.json'), 'r') as f:
+                self._index[unique_id] = _index_record(json.load(f))
+            return True
 
-    def _write(self, x, fpath):
-        np.save(fpath, x)
+        record = _index_record(meta)
+        self._index[unique_id] = record
+        self._append_index(unique_id, record)
+        return True
 
-    def _read(self, fpath):
-        return np.load(fpath, allow_pickle=True).item()
+    def _exists(self, fpath):
+        return exists(join(fpath, 'meta.json')) or exists(fpath + '.npy')
+
+    def _write(self, x, fpath, source=None):
+        make_dir(fpath)
+        fields = {}
+        for key, value in x.items():
+            if value is None:
+                fields[key] = None
+            elif isinstance(value, np.ndarray) and value.dtype != object:
+                np.save(join(fpath, key + '.npy'), np.ascontiguousarray(value))
+                fields[key] = {
+                    'type': 'array',
+                    'dtype': value.dtype.str,
+                    'shape': list(value.shape)
+                }
+            elif isinstance(value, KDTree):
+                save_kdtree(value, join(fpath, key))
+                fields[key] = {'type': 'kdtree'}
+            else:
+                with open(join(fpath, key + '.pkl'), 'wb') as f:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                fields[key] = {'type': 'pickle'}
+
+        # The manifest is written last, a sample without it is incomplete.
+        meta = {
+            'fields': fields,
+            'source': source,
+            'class_counts': _class_counts(x.get('label', None))
+        }
+        with open(join(fpath, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return meta
+
+    def _read(self, fpath, mmap=None):
+        mmap = self.mmap if mmap is None else mmap
+        if not isdir(fpath):
+            # Cache entry written by the former single-file format.
+            return np.load(fpath + '.npy', allow_pickle=True).item()
+
+        with open(join(fpath, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        x = dict()
+        for key, info in meta['fields'].items():
+            x[key] = self._read_field(fpath, key, info, mmap)
+        return x
+
+    def _read_field(self, fpath, key, info, mmap):
+        if info is None:
+            return None
+        elif info['type'] == 'array':
+            mmap_mode = 'r' if mmap and np.prod(info['shape']) > 0 else None
+            return np.load(join(fpath, key + '.npy'), mmap_mode=mmap_mode)
+        elif info['type'] == 'kdtree':
+            return load_kdtree(join(fpath, key), mmap=mmap)
+        else:
+            with open(join(fpath, key + '.pkl'), 'rb') as f:
+                return pickle.load(f)
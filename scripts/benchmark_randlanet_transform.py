@@ -0,0 +1,114 @@
+import argparse
+import time
+import numpy as np
+from sklearn.neighbors import KDTree
+
+from open3d.ml.datasets.utils import DataProcessing
+from open3d.ml.torch.models import RandLANet
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Time the RandLANet transform of a batch of crops')
+    parser.add_argument('--num_cloud_points',
+                        help='number of points of the cloud',
+                        type=int,
+                        default=200000)
+    parser.add_argument('--num_points',
+                        help='number of points of a crop',
+                        type=int,
+                        default=4096 * 11)
+    parser.add_argument('--batch_size',
+                        help='number of crops of a batch',
+                        type=int,
+                        default=4)
+    parser.add_argument('--knn_candidates',
+                        help='neighbors searched per point and layer',
+                        type=int,
+                        default=None)
+    parser.add_argument('--repeats',
+                        help='number of timed batches',
+                        type=int,
+                        default=5)
+
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def knn_per_layer(pc, cfg):
+    """Neighbors of a crop searched layer by layer, as done before."""
+    outputs = []
+    for i in range(cfg.num_layers):
+        neighbour_idx = DataProcessing.knn_search(pc, pc, cfg.k_n)
+        sub_points = pc[:pc.shape[0] // cfg.sub_sampling_ratio[i], :]
+        up_i = DataProcessing.knn_search(sub_points, pc, 1)
+        outputs.append((neighbour_idx.astype(np.int64),
+                        neighbour_idx[:sub_points.shape[0]].astype(np.int64),
+                        up_i.astype(np.int64)))
+        pc = sub_points
+    return outputs
+
+
+def timeit(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def main():
+    args = parse_args()
+
+    model = RandLANet(num_points=args.num_points,
+                      knn_candidates=args.knn_candidates)
+    cfg = model.cfg
+
+    points = np.random.rand(args.num_cloud_points, 3).astype(np.float32) * 50
+    data = {
+        'point': points,
+        'feat': None,
+        'label': np.zeros(args.num_cloud_points, dtype=np.int32),
+        'search_tree': KDTree(points)
+    }
+    attr = {'split': 'training'}
+
+    crops = [
+        model.trans_point_sampler(pc=points,
+                                  search_tree=data['search_tree'],
+                                  num_points=args.num_points)[0]
+        for _ in range(args.batch_size)
+    ]
+    crops = np.stack(crops)
+
+    t_per_layer = timeit(lambda: [knn_per_layer(pc, cfg) for pc in crops],
+                         args.repeats)
+    t_hierarchy = timeit(
+        lambda: DataProcessing.knn_hierarchy(
+            crops,
+            cfg.k_n,
+            cfg.sub_sampling_ratio[:cfg.num_layers],
+            num_candidates=args.knn_candidates), args.repeats)
+    t_transform = timeit(
+        lambda: [model.transform(data, attr) for _ in range(args.batch_size)],
+        args.repeats)
+
+    # Set through the constructor, cfg.get() does not see attributes set on
+    # the config.
+    model = RandLANet(num_points=args.num_points,
+                      knn_candidates=args.knn_candidates,
+                      crops_per_cloud=args.batch_size)
+    t_transform_crops = timeit(lambda: model.transform(data, attr),
+                               args.repeats)
+
+    print("batch of {} crops of {} points".format(args.batch_size,
+                                                  args.num_points))
+    print("neighbors per crop and layer: {:.3f} s".format(t_per_layer))
+    print("neighbors of the batch:       {:.3f} s".format(t_hierarchy))
+    print("transform per crop:           {:.3f} s".format(t_transform))
+    print("transform of the batch:       {:.3f} s".format(t_transform_crops))
+
+
+if __name__ == '__main__':
+    main()
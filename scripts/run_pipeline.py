@@ -62,6 +62,16 @@ def main():
     args.device = _ml3d.utils.convert_device_name(args.device)
     if framework == 'torch':
         import open3d.ml.torch as ml3d
+
+        # Started by torchrun, each process trains on its part of the data.
+        if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+            import torch
+            import torch.distributed as dist
+            if args.device == 'cpu' or not torch.cuda.is_available():
+                dist.init_process_group('gloo')
+            else:
+                dist.init_process_group('nccl')
+                torch.cuda.set_device(int(os.environ['LOCAL_RANK']))
     else:
         import tensorflow as tf
         import open3d.ml.tf as ml3d
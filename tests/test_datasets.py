@@ -0,0 +1,210 @@
+import pytest
+import numpy as np
+
+
+def test_cache(tmp_path):
+    from open3d.ml.utils import Cache
+
+    def preprocess(data, attr):
+        return {
+            'point': data['point'],
+            'label': data['label'],
+            'proj_inds': None,
+            'attr': attr
+        }
+
+    rng = np.random.default_rng(0)
+    data = {
+        'point': rng.random((100, 3), dtype=np.float32),
+        'label': rng.integers(4, size=100, dtype=np.int32)
+    }
+    attr = {'name': 'cloud'}
+
+    cache = Cache(preprocess, str(tmp_path), 'key')
+    out = cache('cloud', data, attr)
+    assert isinstance(out['point'], np.memmap)
+    np.testing.assert_array_equal(out['point'], data['point'])
+    np.testing.assert_array_equal(out['label'], data['label'])
+    assert out['proj_inds'] is None
+    assert out['attr'] == attr
+
+    # Another process finds the sample in the index, without preprocessing.
+    cache = Cache(None, str(tmp_path), 'key')
+    assert cache.missing(['cloud', 'other']) == ['other']
+    assert cache.num_points('cloud') == 100
+    assert cache.class_counts('cloud') == np.bincount(data['label']).tolist()
+    np.testing.assert_array_equal(cache('cloud')['point'], data['point'])
+    np.testing.assert_array_equal(cache.get_field('cloud', 'label'),
+                                  data['label'])
+
+
+class _Split(object):
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get_attr(self, idx):
+        return {'name': 'cloud{}'.format(idx), 'path': self.paths[idx]}
+
+    def get_data(self, idx):
+        return {'point': np.load(self.paths[idx])}
+
+
+def test_cache_warmup(tmp_path):
+    from open3d.ml.utils import Cache
+
+    calls = []
+
+    def preprocess(data, attr):
+        calls.append(attr['name'])
+        return {'point': data['point']}
+
+    paths = [str(tmp_path / 'cloud{}.npy'.format(i)) for i in range(3)]
+    for path in paths:
+        np.save(path, np.zeros((10, 3), dtype=np.float32))
+    split = _Split(paths)
+
+    cache = Cache(preprocess, str(tmp_path / 'cache'), 'key')
+    cache.warmup(split)
+    assert sorted(calls) == ['cloud0', 'cloud1', 'cloud2']
+    assert cache.missing(['cloud0', 'cloud1', 'cloud2']) == []
+
+    # A changed source is only preprocessed again with check_stale.
+    np.save(paths[1], np.ones((20, 3), dtype=np.float32))
+    calls.clear()
+    cache.warmup(split)
+    assert calls == []
+    cache.warmup(split, check_stale=True)
+    assert calls == ['cloud1']
+    assert cache.num_points('cloud1') == 20
+
+
+def _read_shared_samples(args):
+    from open3d.ml.utils import Cache
+
+    cache_dir, shm_dir, mem_size, points = args
+    cache = Cache(None, cache_dir, 'key', mem_size=mem_size, shm_dir=shm_dir)
+    for i in range(50):
+        name = str(i % len(points))
+        np.testing.assert_array_equal(cache(name)['point'], points[int(name)])
+    return cache.hits, cache.misses
+
+
+def test_cache_shared(tmp_path):
+    import multiprocessing
+    from open3d.ml.utils import Cache
+    from open3d.ml.utils.dataset_helper import _dir_nbytes
+
+    def preprocess(data, attr):
+        return {'point': data['point']}
+
+    rng = np.random.default_rng(0)
+    points = [rng.random((100, 3), dtype=np.float32) for _ in range(3)]
+    cache = Cache(preprocess, str(tmp_path / 'cache'), 'key')
+    for i, point in enumerate(points):
+        cache(str(i), {'point': point}, {})
+    mem_size = max(
+        _dir_nbytes(str(tmp_path / 'cache' / 'key' / str(i)))
+        for i in range(len(points)))
+
+    # Two workers evict each other from a shared tier of one sample.
+    args = (str(tmp_path / 'cache'), str(tmp_path / 'shm'), mem_size, points)
+    with multiprocessing.get_context('spawn').Pool(2) as pool:
+        for hits, misses in pool.map(_read_shared_samples, [args] * 2):
+            assert hits + misses == 50
+
+
+def test_kdtree(tmp_path):
+    from sklearn.neighbors import KDTree
+    from open3d.ml.utils import save_kdtree, load_kdtree
+
+    rng = np.random.default_rng(0)
+    points = rng.random((1000, 3))
+    queries = rng.random((10, 3))
+    tree = KDTree(points)
+
+    save_kdtree(tree, str(tmp_path / 'tree'))
+    for mmap in [True, False]:
+        loaded = load_kdtree(str(tmp_path / 'tree'), mmap=mmap)
+        np.testing.assert_array_equal(loaded.data, points)
+        dist, idx = loaded.query(queries, k=8)
+        expected_dist, expected_idx = tree.query(queries, k=8)
+        np.testing.assert_array_equal(idx, expected_idx)
+        np.testing.assert_array_equal(dist, expected_dist)
+
+
+def test_block_min():
+    from open3d.ml.datasets.samplers.semseg_spatially_regular import _BlockMin
+
+    rng = np.random.default_rng(0)
+    for size in [1, 10, 101]:
+        block_min = _BlockMin(np.zeros(_BlockMin.get_nbytes(size), np.uint8),
+                              size)
+        values = rng.random(size)
+        block_min.initialize(values, rng.permutation(size))
+        for i in range(50):
+            idxs = rng.choice(size, size=rng.integers(1, size + 1))
+            # Only increased, as for a crop, or also decreased.
+            delta = rng.random(len(idxs)) - 0.2 * (i % 2)
+            # Repeated indices are added once, like a crop.
+            idxs, first = np.unique(idxs, return_index=True)
+            delta = delta[first]
+            block_min.add(idxs, delta)
+            values[idxs] += delta
+
+            np.testing.assert_array_equal(block_min.values, values)
+            assert block_min.argmin() == np.argmin(values)
+            assert block_min.min() == np.min(values)
+
+
+def test_random_sampler_length():
+    from open3d.ml.datasets import SemSegRandomSampler
+
+    # Fewer samples per epoch than clouds, e.g. with several crops per
+    # cloud, still draw from all clouds.
+    sampler = SemSegRandomSampler(list(range(6)))
+    sampler.length = 2
+    ids = set()
+    for _ in range(50):
+        epoch = [int(i) for i in sampler.get_cloud_sampler()]
+        assert len(epoch) == 2
+        ids.update(epoch)
+    assert ids == set(range(6))
+
+
+def _knn(queries, supports, k):
+    dists = np.sum((queries[:, None] - supports[None])**2, axis=-1)
+    return np.argsort(dists, axis=1, kind='stable')[:, :k]
+
+
+def test_knn_hierarchy():
+    from open3d.ml.datasets.utils import DataProcessing
+
+    rng = np.random.default_rng(0)
+    points = rng.random((3, 512, 3))
+    k = 8
+    ratios = [4, 4, 4, 2]
+
+    # Without candidates to reuse, with some and with more than the points
+    # of the last layers.
+    for num_candidates in [None, 2 * k, 64]:
+        points_l, neighbors, pools, up_samples = DataProcessing.knn_hierarchy(
+            points, k, ratios, num_candidates)
+        assert len(points_l) == len(ratios)
+
+        num_points = points.shape[1]
+        for layer, ratio in enumerate(ratios):
+            num_sub = num_points // ratio
+            for b in range(points.shape[0]):
+                pc = points[b, :num_points]
+                np.testing.assert_array_equal(points_l[layer][b], pc)
+                np.testing.assert_array_equal(neighbors[layer][b],
+                                              _knn(pc, pc, k))
+                np.testing.assert_array_equal(pools[layer][b],
+                                              _knn(pc[:num_sub], pc, k))
+                np.testing.assert_array_equal(up_samples[layer][b],
+                                              _knn(pc, pc[:num_sub], 1))
+            num_points = num_sub
@@ -0,0 +1,197 @@
+import pytest
+import numpy as np
+
+
+def _train_step(rank, world_size, init_file, num_samples):
+    import torch
+    import torch.distributed as dist
+    from torch.nn.parallel import DistributedDataParallel
+    import open3d.ml.torch as ml3d
+    from open3d.ml.datasets import SemSegRandomSampler
+
+    dist.init_process_group('gloo',
+                            init_method='file://' + init_file,
+                            rank=rank,
+                            world_size=world_size)
+    try:
+        # Each rank keeps its own part of the samples drawn by all ranks.
+        sampler = SemSegRandomSampler()
+        sampler.length = num_samples
+        ids = [int(i) for i in ml3d.dataloaders.get_sampler(sampler)]
+        shards = [None] * world_size
+        dist.all_gather_object(shards, ids)
+        all_ids = sum(shards, [])
+        assert len(all_ids) == len(set(all_ids)) == num_samples
+
+        # One training step on the samples of the rank, as in run_train.
+        torch.manual_seed(0)
+        model = torch.nn.Linear(3, 2)
+        train_model = DistributedDataParallel(model)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        inputs = torch.from_numpy(
+            np.random.default_rng(ids).random((len(ids), 3), dtype=np.float32))
+
+        optimizer.zero_grad()
+        loss = train_model(inputs).square().mean()
+        loss.backward()
+        optimizer.step()
+
+        grads = [None] * world_size
+        params = [None] * world_size
+        dist.all_gather_object(grads, [p.grad for p in model.parameters()])
+        dist.all_gather_object(params, [p.detach() for p in model.parameters()])
+        for other_grads, other_params in zip(grads[1:], params[1:]):
+            for a, b in zip(grads[0], other_grads):
+                assert torch.equal(a, b)
+            for a, b in zip(params[0], other_params):
+                assert torch.equal(a, b)
+        assert any(g.abs().sum() > 0 for g in grads[0])
+    finally:
+        dist.destroy_process_group()
+
+
+def test_distributed_torch(tmp_path):
+    import torch.distributed as dist
+    import torch.multiprocessing as mp
+
+    if not dist.is_available():
+        pytest.skip('torch.distributed is not available')
+
+    world_size = 2
+    mp.spawn(_train_step,
+             args=(world_size, str(tmp_path / 'init'), 10),
+             nprocs=world_size)
+
+
+class _Loader(list):
+    generator = None
+    pin_memory = False
+
+
+class _Batcher(object):
+    device = 'cpu'
+
+    def collate_fn(self, samples, pin_memory=False):
+        return samples
+
+
+def _packed_steps(rank, world_size, init_file):
+    import torch.distributed as dist
+    from open3d.ml.utils import Config
+    import open3d.ml.torch as ml3d
+
+    dist.init_process_group('gloo',
+                            init_method='file://' + init_file,
+                            rank=rank,
+                            world_size=world_size)
+    try:
+        # Samples of 4 points packed by 8, rank r has r + 1 batches.
+        cfg = Config({'batch_limit': 8})
+        sample = {'data': {'p_list': [np.zeros((4, 3))], 'cfg': cfg}}
+        loader = _Loader([[sample] * 2] * (rank + 1))
+        batcher = _Batcher()
+
+        packed = ml3d.dataloaders.PackedBatches(loader, batcher)
+        assert len(list(packed)) == rank + 1
+
+        packed = ml3d.dataloaders.PackedBatches(loader,
+                                                batcher,
+                                                even_steps=True)
+        assert len(list(packed)) == 1
+    finally:
+        dist.destroy_process_group()
+
+
+def test_packed_batches_torch(tmp_path):
+    import torch.distributed as dist
+    import torch.multiprocessing as mp
+
+    if not dist.is_available():
+        pytest.skip('torch.distributed is not available')
+
+    world_size = 3
+    mp.spawn(_packed_steps,
+             args=(world_size, str(tmp_path / 'init')),
+             nprocs=world_size)
+
+
+class _Split(object):
+    split = 'test'
+    cfg = {}
+
+    def __len__(self):
+        return 5
+
+    def get_data(self, idx):
+        return {'point': np.zeros((10 + idx, 3), dtype=np.float32)}
+
+
+class _Model(object):
+
+    def __init__(self):
+        from open3d.ml.utils import Config
+        self.cfg = Config({'num_classes': 3})
+
+    def preprocess(self, data, attr):
+        return {'proj_inds': np.arange(data['point'].shape[0])}
+
+    def update_probs(self, inputs, results, test_probs, test_labels):
+        return test_probs + 1, test_labels
+
+
+def _test_clouds(rank, world_size, init_file):
+    import torch.distributed as dist
+    import open3d.ml.torch as ml3d
+    from open3d.ml.datasets import SemSegSpatiallyRegularSampler
+
+    dist.init_process_group('gloo',
+                            init_method='file://' + init_file,
+                            rank=rank,
+                            world_size=world_size)
+    try:
+        split = _Split()
+        sampler = SemSegSpatiallyRegularSampler(split)
+        sampler.initialize_with_dataloader(
+            ml3d.dataloaders.TorchDataloader(dataset=split, use_cache=False))
+
+        pipeline = object.__new__(ml3d.pipelines.SemanticSegmentation)
+        pipeline.model = _Model()
+        pipeline.dataset_split = split
+        pipeline.curr_cloud_id = -1
+        pipeline.test_probs = {}
+        pipeline.test_labels = {}
+        pipeline.ori_test_probs = []
+        pipeline.ori_test_labels = []
+
+        # Each rank tests its own clouds, each is covered by two crops.
+        done = []
+        for cloud_id in ml3d.dataloaders.get_sampler(sampler):
+            pc = split.get_data(cloud_id)['point']
+            possibility = sampler._get_cloud(cloud_id, pc)
+            possibility.add(np.arange(pc.shape[0]), 0.3)
+            sampler.min_possibilities[cloud_id] = possibility.min()
+
+            inputs = {'attr': [{'idx': cloud_id}]}
+            pipeline.update_tests(sampler, inputs, None)
+            if pipeline.complete_infer:
+                done.append(cloud_id)
+                probs = pipeline.ori_test_probs.pop()
+                assert probs.shape == (pc.shape[0], 3)
+                assert np.all(probs == 2)
+
+        assert done == list(range(rank, len(split), world_size))
+    finally:
+        dist.destroy_process_group()
+
+
+def test_distributed_test_split_torch(tmp_path):
+    import torch.distributed as dist
+    import torch.multiprocessing as mp
+
+    if not dist.is_available():
+        pytest.skip('torch.distributed is not available')
+
+    world_size = 2
+    mp.spawn(_test_clouds,
+             args=(world_size, str(tmp_path / 'init')),
+             nprocs=world_size)
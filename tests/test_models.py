@@ -106,6 +106,114 @@ def test_kpconv_torch():
     assert out.shape[1] == 5
 
 
+def _radius_neighbors(queries, q_lengths, supports, s_lengths, radius):
+    """Sets of the supports within radius of each query, in its sample."""
+    neighbors = []
+    i0, j0 = 0, 0
+    for q_n, s_n in zip(q_lengths, s_lengths):
+        dists = np.sum(
+            (queries[i0:i0 + q_n, None] - supports[None, j0:j0 + s_n])**2, -1)
+        neighbors += [set(np.flatnonzero(d < radius**2) + j0) for d in dists]
+        i0 += q_n
+        j0 += s_n
+    return neighbors
+
+
+def test_kpconv_layers_torch():
+    import open3d.ml.torch as ml3d
+
+    net = ml3d.models.KPFCNN(lbl_values=[0, 1, 2, 3, 4, 5],
+                             num_classes=4,
+                             ignored_label_inds=[0],
+                             in_features_dim=5)
+
+    # The layers of each sample, concatenated as by the batcher.
+    rng = np.random.default_rng(0)
+    clouds = [rng.random((n, 3), dtype=np.float32) for n in [300, 500, 400]]
+    layers = ml3d.dataloaders.concat_batcher.CustomBatch.concat_layers([
+        net.segmentation_inputs(pc, np.array([pc.shape[0]], dtype=np.int32))
+        for pc in clouds
+    ])
+
+    np.testing.assert_array_equal(layers['points'][0], np.concatenate(clouds))
+    num_layers = len(layers['points'])
+    r = net.cfg.first_subsampling_dl * net.cfg.conv_radius
+    for layer in range(num_layers):
+        points = layers['points'][layer]
+        lengths = layers['lengths'][layer]
+        np.testing.assert_array_equal(lengths.sum(), points.shape[0])
+
+        # Same neighbors as a radius search over the whole batch, shadow
+        # neighbors are the number of supports of the batch.
+        searches = [('neighbors', points, lengths, points, lengths, r)]
+        if layer + 1 < num_layers:
+            sub_points = layers['points'][layer + 1]
+            sub_lengths = layers['lengths'][layer + 1]
+            searches += [('pools', sub_points, sub_lengths, points, lengths, r),
+                         ('upsamples', points, lengths, sub_points, sub_lengths,
+                          2 * r)]
+
+        for key, queries, q_lengths, supports, s_lengths, radius in searches:
+            inds = layers[key][layer]
+            assert inds.shape[0] == queries.shape[0]
+            assert np.all(inds <= supports.shape[0])
+            expected = _radius_neighbors(queries, q_lengths, supports,
+                                         s_lengths, radius)
+            for row, neighbors in zip(inds, expected):
+                assert set(row[row < supports.shape[0]]) == neighbors
+        r *= 2
+
+
+def test_kpconv_blocks_torch(tmp_path, monkeypatch):
+    import torch
+    from open3d.ml.torch.models.kpconv import KPConv
+
+    # The kernel dispositions are written to the working directory.
+    monkeypatch.chdir(tmp_path)
+
+    rng = np.random.default_rng(0)
+    points = rng.random((300, 3), dtype=np.float32)
+    dists = np.sum((points[:, None] - points[None])**2, axis=-1)
+    # Neighbors within the radius, padded with the shadow index.
+    neighbors = np.full((300, 40), 300, dtype=np.int64)
+    for i, d in enumerate(dists):
+        inds = np.flatnonzero(d < 0.2**2)[:40]
+        neighbors[i, :len(inds)] = inds
+    points = torch.from_numpy(points)
+    neighbors = torch.from_numpy(neighbors)
+    features = rng.random((300, 8), dtype=np.float32)
+
+    for deformable, modulated in [(False, False), (True, False), (True, True)]:
+        outputs = []
+        grads = []
+        for block_size in [None, 64, 'auto']:
+            torch.manual_seed(0)
+            conv = KPConv(15,
+                          3,
+                          8,
+                          16,
+                          KP_extent=0.1,
+                          radius=0.2,
+                          deformable=deformable,
+                          modulated=modulated,
+                          block_size=block_size)
+            if outputs:
+                conv.load_state_dict(state_dict)
+            state_dict = conv.state_dict()
+
+            x = torch.tensor(features, requires_grad=True)
+            out = conv(points, points, neighbors, x)
+            out.square().sum().backward()
+            outputs.append(out.detach())
+            grads.append([x.grad] + [p.grad for p in conv.parameters()])
+
+        for out, out_grads in zip(outputs[1:], grads[1:]):
+            torch.testing.assert_close(out, outputs[0])
+            for a, b in zip(out_grads, grads[0]):
+                if a is not None or b is not None:
+                    torch.testing.assert_close(a, b)
+
+
 def test_kpconv_tf():
     import tensorflow as tf
     import open3d.ml.tf as ml3d
@@ -144,3 +252,46 @@ def test_kpconv_tf():
     out = net(inputs)
 
     assert out.shape == (1000, 5)
+
+
+def test_semseg_metric_torch():
+    import torch
+    from open3d.ml.torch.modules.metrics import SemSegMetric
+    from open3d.ml.utils import Config
+
+    num_classes = 5
+    model = type('Model', (), {'cfg': Config({'num_classes': num_classes})})
+    metric = SemSegMetric(None, model, None, 'cpu')
+
+    rng = np.random.default_rng(0)
+    scores = torch.from_numpy(rng.random((2, num_classes, 1000)))
+    # The last class is never a label.
+    labels = torch.from_numpy(rng.integers(num_classes - 1, size=(2, 1000)))
+    for i in range(2):
+        metric.update(scores[i], labels[i])
+
+    # Per-class loop over all the points.
+    predictions = torch.max(scores, dim=-2).indices.numpy()
+    labels = labels.numpy()
+    conf_m = np.zeros((num_classes, num_classes), dtype=np.int64)
+    accs, ious = [], []
+    for label in range(num_classes):
+        for pred in range(num_classes):
+            conf_m[label][pred] = np.sum(
+                np.logical_and(labels == label, predictions == pred))
+        with np.errstate(invalid='ignore'):
+            accs.append(
+                np.sum((predictions == labels) & (labels == label)) /
+                np.sum(labels == label))
+            ious.append(
+                np.sum((predictions == label) & (labels == label)) /
+                np.sum((predictions == label) | (labels == label)))
+    accs.append(np.nanmean(accs))
+    ious.append(np.nanmean(ious))
+
+    np.testing.assert_array_equal(metric.conf_m.numpy(), conf_m)
+    np.testing.assert_allclose(metric.acc(), accs)
+    np.testing.assert_allclose(metric.iou(), ious)
+    np.testing.assert_array_equal(
+        metric.confusion_matrix(scores, torch.from_numpy(labels)).numpy(),
+        conf_m)